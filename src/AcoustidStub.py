@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import gzip
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+
+from io import BytesIO
+
+try:
+    from urlparse import parse_qs
+    from SocketServer import ThreadingMixIn
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from urllib.parse import parse_qs
+    from socketserver import ThreadingMixIn
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+#error codes of the AcoustID Web service
+ERROR_INTERNAL = 5
+ERROR_RATE_LIMIT = 14
+
+
+########################################################################
+# Responses
+########################################################################
+def synthetic_lookup(fingerprint):
+    """Builds a lookup response that always gives the same recording for
+    the same fingerprint
+    """
+
+    digest = hashlib.md5(fingerprint.encode('utf8')).hexdigest()
+    return {
+        'status': 'ok',
+        'results': [{
+            'id': digest,
+            'score': 0.9,
+            'recordings': [{
+                'id': '{}-{}-{}-{}-{}'.format(digest[:8], digest[8:12],
+                    digest[12:16], digest[16:20], digest[20:]),
+                'title': 'Title {}'.format(digest[:6]),
+                'artists': [{'name': 'Artist {}'.format(digest[6:12])}],
+            }],
+        }],
+    }
+
+
+def synthetic_submit(params, first_id):
+    """Accepts every fingerprint of a submission. Like the service, the
+    index of each submission is a string
+    """
+
+    indexes = sorted(set([int(k.rsplit('.', 1)[1]) for k in params
+        if k.startswith('fingerprint.')]))
+    return {
+        'status': 'ok',
+        'submissions': [{'index': str(i), 'id': first_id + n, 'status': 'pending'}
+            for n, i in enumerate(indexes)],
+    }
+
+
+def error(code, message):
+    return {'status': 'error', 'error': {'code': code, 'message': message}}
+
+
+########################################################################
+# Server
+########################################################################
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if(self.headers.get('Content-Encoding') == 'gzip'):
+            body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+        params = dict([(k, v[0]) for k, v in parse_qs(body.decode('utf8')).items()])
+
+        status, response = server.respond(self.path, params)
+
+        data = json.dumps(response).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if(self.server.verbose):
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the AcoustID Web service. Each request waits
+    latency seconds plus up to jitter seconds, fails with probability
+    error_rate, and is rejected like the real service when more than
+    rate_limit requests per second arrive (0 disables the limit).
+    Lookups are answered from the responses recorded by
+    acoustid.set_replay(path, 'record') if the fingerprint was recorded,
+    otherwise with a synthetic response. Use it with
+    acoustid.set_base_url(server.url)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0,
+        error_rate=0.0, rate_limit=3, recorded=None, seed=None,
+        verbose=False):
+
+        HTTPServer.__init__(self, address, StubHandler)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.responses = {}
+        if(recorded):
+            self.load(recorded)
+
+        #stats
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.submitted = 0
+
+        self._lock = threading.Lock()
+        self._window = []
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/v2/'.format(*self.server_address[:2])
+
+    def load(self, path):
+        """Loads the lookup responses of a file recorded by acoustid
+        """
+        with open(path) as f:
+            for line in f:
+                if(line.strip()):
+                    entry = json.loads(line)
+                    if(entry['endpoint'] == 'lookup'):
+                        self.responses[entry['params']['fingerprint']] = entry['response']
+
+    def respond(self, path, params):
+        """Returns the HTTP status and the response for a request
+        """
+
+        with self._lock:
+            self.requests += 1
+            now = time.time()
+
+            #requests of the last second
+            self._window = [t for t in self._window if(now - t < 1)]
+            throttled = self.rate_limit and len(self._window) >= self.rate_limit
+            self._window.append(now)
+
+            failed = self.random.random() < self.error_rate
+            delay = self.latency + self.random.random() * self.jitter
+
+        time.sleep(delay)
+
+        if(throttled):
+            with self._lock:
+                self.throttled += 1
+            return 503, error(ERROR_RATE_LIMIT, 'rate limit exceeded')
+
+        if(failed):
+            with self._lock:
+                self.errors += 1
+            return 500, error(ERROR_INTERNAL, 'internal error')
+
+        if(path.rstrip('/').endswith('/lookup')):
+            fingerprint = params.get('fingerprint', '')
+            if(fingerprint in self.responses):
+                return 200, self.responses[fingerprint]
+            return 200, synthetic_lookup(fingerprint)
+
+        if(path.rstrip('/').endswith('/submit')):
+            with self._lock:
+                response = synthetic_submit(params, self.submitted)
+                self.submitted += len(response['submissions'])
+            return 200, response
+
+        return 404, error(ERROR_INTERNAL, 'unknown endpoint')
+
+    def start(self):
+        """Serves from a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'throttled': self.throttled,
+                'submitted': self.submitted,
+            }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the AcoustID Web service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds added to each response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help='max random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='probability of answering with an error')
+    parser.add_argument('--rate-limit', type=int, default=3,
+        help='requests per second, 0 disables the limit')
+    parser.add_argument('--recorded', metavar='PATH',
+        help='responses recorded with acoustid.set_replay')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(args)
+
+    server = StubServer((args.host, args.port), args.latency, args.jitter,
+        args.error_rate, args.rate_limit, args.recorded, args.seed,
+        args.verbose)
+    sys.stderr.write('Serving on {}\n'.format(server.url))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    sys.stderr.write('{}\n'.format(server.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import math
+import time
+import wave
+import random
+import struct
+import shutil
+import tempfile
+import argparse
+
+from Raudio import FromFile, FromStream, SongAssembler
+from Encoder import make_encoder, EncoderException
+from Pipeline import Pipeline
+
+try:
+    import acoustid
+    from AcoustidStub import StubServer
+except ImportError:
+    acoustid = None
+
+
+########################################################################
+# Synthetic audio
+########################################################################
+def _pack(samples, sample_width):
+    """Packs signed samples with the same layout that Raudio unpacks
+    """
+
+    if(sample_width == 1):
+        return struct.pack('<{}b'.format(len(samples)), *samples)
+    elif(sample_width == 2):
+        return struct.pack('<{}h'.format(len(samples)), *samples)
+    elif(sample_width == 3):
+        return b''.join([struct.pack('<l', s)[:3] for s in samples])
+    else:
+        return struct.pack('<{}l'.format(len(samples)), *samples)
+
+
+def generate_wav(path, length=60, channels=2, sample_width=2,
+    frame_rate=44100, song_length=20, silence_length=1, noise_floor=5,
+    amplitude=0.5, seed=0):
+    """Writes a wav of length seconds that alternates songs of
+    song_length seconds (a 440Hz tone with noise) and silences of
+    silence_length seconds (noise with peaks up to noise_floor). Songs
+    have short gaps of 50ms every 5 seconds, like the ones tolerated by
+    the song assembler. One second of each kind is synthesized and
+    repeated, so long files are generated quickly
+    """
+
+    rnd = random.Random(seed)
+    peak = int((2 ** (8 * sample_width - 1) - 1) * amplitude)
+
+    def second(sound):
+        samples = []
+        for i in range(frame_rate):
+            noise = rnd.randint(-noise_floor, noise_floor)
+            value = noise
+            if(sound):
+                value += int(peak * math.sin(2 * math.pi * 440 * i / frame_rate))
+            samples.extend([value] * channels)
+        return _pack(samples, sample_width)
+
+    sound = second(True)
+    silence = second(False)
+    frame_size = channels * sample_width
+
+    def frames(data, n):
+        """n frames of data, repeating it as needed"""
+        size = n * frame_size
+        return (data * (size // len(data) + 1))[:size]
+
+    audio = wave.open(path, 'wb')
+    audio.setnchannels(channels)
+    audio.setsampwidth(sample_width)
+    audio.setframerate(frame_rate)
+
+    total = int(length * frame_rate)
+    written = 0
+    gap = int(0.05 * frame_rate)
+    in_song = False
+
+    while(written < total):
+        if(in_song):
+            n = min(int(song_length * frame_rate), total - written)
+            for o in range(0, n, 5 * frame_rate):
+                part = min(5 * frame_rate, n - o)
+                audio.writeframes(frames(sound, part - min(gap, part)))
+                audio.writeframes(frames(silence, min(gap, part)))
+        else:
+            n = min(int(silence_length * frame_rate), total - written)
+            audio.writeframes(frames(silence, n))
+
+        written += n
+        in_song = not in_song
+
+    audio.close()
+    return path
+
+
+########################################################################
+# Benchmarks
+########################################################################
+class Skip(Exception):
+    """The benchmark can not run in this environment"""
+
+
+def _result(name, seconds, frames=0, size=0, items=0):
+    return {
+        'name': name,
+        'seconds': seconds,
+        'frames': frames,
+        'bytes': size,
+        'items': items,
+        'frames_per_sec': frames / seconds if(seconds) else 0.0,
+        'mb_per_sec': size / seconds / 1e6 if(seconds) else 0.0,
+        'items_per_sec': items / seconds if(seconds) else 0.0,
+    }
+
+
+def _audio_params(path):
+    audio = wave.open(path, 'rb')
+    params = (audio.getnframes(), audio.getnchannels(), audio.getsampwidth(),
+        audio.getframerate())
+    audio.close()
+    return params
+
+
+def _segment(path, threshold, max_silence_length=None):
+    chunks = []
+    worker = FromFile(path, threshold=threshold, update_callback=chunks.extend,
+        batch_size=256, max_silence_length=max_silence_length)
+    worker.start()
+    worker.wait()
+    return chunks
+
+
+def _songs(chunks, frame_rate):
+    songs = []
+    assembler = SongAssembler(songs.append, frame_rate)
+    for c in chunks:
+        assembler.add(c)
+    assembler.flush()
+    return songs
+
+
+def bench_segment_file(path, threshold, workdir):
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+
+    start = time.time()
+    chunks = _segment(path, threshold)
+    seconds = time.time() - start
+
+    return _result('segment_file', seconds, nframes,
+        nframes * channels * sample_width, len(chunks))
+
+
+def bench_segment_coarse(path, threshold, workdir):
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+
+    start = time.time()
+    chunks = _segment(path, threshold, max_silence_length=0.2)
+    seconds = time.time() - start
+
+    return _result('segment_coarse', seconds, nframes,
+        nframes * channels * sample_width, len(chunks))
+
+
+def bench_segment_stream(path, threshold, workdir):
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+    chunks = []
+
+    #the spill is deleted after the timing, it's not part of the scan
+    with open(path, 'rb') as f:
+        start = time.time()
+        worker = FromStream(f, threshold=threshold,
+            update_callback=chunks.append, remove_spill=False)
+        worker.start()
+        try:
+            worker.wait()
+            seconds = time.time() - start
+        finally:
+            worker.join()
+            if(hasattr(worker, 'spill')):
+                worker.spill.remove()
+
+    return _result('segment_stream', seconds, nframes,
+        nframes * channels * sample_width, len(chunks))
+
+
+def bench_assemble(path, threshold, workdir):
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+    chunks = _segment(path, threshold)
+
+    start = time.time()
+    _songs(chunks, frame_rate)
+    seconds = time.time() - start
+
+    return _result('assemble', seconds, nframes, 0, len(chunks))
+
+
+def _bench_export(name, encoder, path, threshold, workdir):
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+    songs = _songs(_segment(path, threshold), frame_rate)
+
+    frames = sum([c.size for song in songs for c in song])
+    written = 0
+
+    start = time.time()
+    for i, song in enumerate(songs):
+        output = os.path.join(workdir, '{}_{}.{}'.format(name, i, encoder.extension))
+        try:
+            written += encoder.encode(output, song)
+        except EncoderException as e:
+            raise Skip(str(e))
+    seconds = time.time() - start
+
+    result = _result(name, seconds, frames, frames * channels * sample_width,
+        len(songs))
+    result['bytes_written'] = written
+    return result
+
+
+def bench_export_wav(path, threshold, workdir):
+    return _bench_export('export_wav', make_encoder('wav'), path,
+        threshold, workdir)
+
+
+def bench_export_flac(path, threshold, workdir):
+    return _bench_export('export_flac', make_encoder('flac'), path,
+        threshold, workdir)
+
+
+def bench_pipeline(path, threshold, workdir):
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+    songs = []
+    output = tempfile.mkdtemp(dir=workdir)
+
+    start = time.time()
+    pipeline = Pipeline(path, output, threshold=threshold,
+        song_callback=songs.append)
+    pipeline.start()
+    pipeline.join()
+    seconds = time.time() - start
+
+    result = _result('pipeline', seconds, nframes,
+        nframes * channels * sample_width, len(songs))
+    result['stages'] = pipeline.stats()
+    return result
+
+
+def bench_fingerprint(path, threshold, workdir):
+    if(not acoustid or not acoustid.have_chromaprint):
+        raise Skip('chromaprint is not available')
+
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+    if(sample_width != 2):
+        raise Skip('the fingerprinter needs 16-bit samples')
+
+    audio = wave.open(path, 'rb')
+    frames = min(nframes, frame_rate * acoustid.MAX_AUDIO_LENGTH)
+    data = audio.readframes(frames)
+    audio.close()
+    blocks = [data[o:o + 4096] for o in range(0, len(data), 4096)]
+
+    start = time.time()
+    acoustid.fingerprint(frame_rate, channels, iter(blocks))
+    seconds = time.time() - start
+
+    return _result('fingerprint', seconds, frames, len(data), 1)
+
+
+def bench_match(path, threshold, workdir):
+    """fingerprint_file and lookup with the web service replaced by a stub
+    that answers immediately
+    """
+    if(not acoustid):
+        raise Skip('acoustid is not available')
+
+    nframes, channels, sample_width, frame_rate = _audio_params(path)
+    response = {'status': 'ok', 'results': [{'score': 1.0, 'id': 'stub',
+        'recordings': [{'id': 'stub', 'title': 'Title',
+        'artists': [{'name': 'Artist'}]}]}]}
+
+    api_request = acoustid._api_request
+    acoustid._api_request = lambda url, params, *args, **kwargs: response
+    try:
+        start = time.time()
+        list(acoustid.match('benchmark', path))
+        seconds = time.time() - start
+    except acoustid.FingerprintGenerationError as e:
+        raise Skip(str(e))
+    finally:
+        acoustid._api_request = api_request
+
+    frames = min(nframes, frame_rate * acoustid.MAX_AUDIO_LENGTH)
+    return _result('match', seconds, frames,
+        frames * channels * sample_width, 1)
+
+
+def bench_submit(path, threshold, workdir, fingerprints=500):
+    """Batched submissions through SubmissionQueue to a local stub of the
+    web service, recording the responses. Every fingerprint must be 
+    accepted
+    """
+    if(not acoustid):
+        raise Skip('acoustid is not available')
+
+    server = StubServer(rate_limit=0)
+    server.start()
+    base_url = acoustid.API_BASE_URL
+    acoustid.set_base_url(server.url)
+    acoustid.set_replay(os.path.join(workdir, 'submit.jsonl'), 'record')
+
+    failed = []
+    def on_done(data, submission, error):
+        if(error is not None):
+            failed.append(error)
+
+    try:
+        start = time.time()
+        queue = acoustid.SubmissionQueue('benchmark', 'benchmark',
+            callback=on_done)
+        for i in range(fingerprints):
+            queue.add({'fingerprint': 'AQAA{:08d}'.format(i).encode('ascii'),
+                'duration': 180})
+        queue.close()
+        seconds = time.time() - start
+    finally:
+        acoustid.set_replay(None)
+        acoustid.set_base_url(base_url)
+        server.stop()
+
+    if(failed):
+        raise AssertionError('{} fingerprints failed: {}'.format(len(failed),
+            failed[0]))
+
+    result = _result('submit', seconds, 0, 0, fingerprints)
+    result['batches'] = queue.batches
+    return result
+
+
+BENCHMARKS = [
+    bench_segment_file,
+    bench_segment_coarse,
+    bench_segment_stream,
+    bench_assemble,
+    bench_export_wav,
+    bench_export_flac,
+    bench_pipeline,
+    bench_fingerprint,
+    bench_match,
+    bench_submit,
+]
+
+
+def run(length=60, channels=2, sample_width=2, frame_rate=44100,
+    song_length=20, silence_length=1, noise_floor=5, threshold=10,
+    repeat=1, names=None):
+    """Generates a synthetic wav with the given parameters and runs the
+    benchmarks on it. Returns a dict with the parameters and the best
+    result of each benchmark in repeat runs
+    """
+
+    params = {
+        'length': length,
+        'channels': channels,
+        'sample_width': sample_width,
+        'frame_rate': frame_rate,
+        'song_length': song_length,
+        'silence_length': silence_length,
+        'noise_floor': noise_floor,
+        'threshold': threshold,
+    }
+    report = {
+        'params': params,
+        'python': sys.version.split()[0],
+        'time': time.time(),
+        'results': [],
+        'skipped': {},
+    }
+
+    workdir = tempfile.mkdtemp(prefix='raudian_bench_')
+    try:
+        path = generate_wav(os.path.join(workdir, 'input.wav'), length,
+            channels, sample_width, frame_rate, song_length,
+            silence_length, noise_floor)
+
+        for bench in BENCHMARKS:
+            name = bench.__name__[len('bench_'):]
+            if(names and name not in names):
+                continue
+
+            best = None
+            try:
+                for i in range(repeat):
+                    result = bench(path, (threshold,) * channels, workdir)
+                    if(best is None or result['seconds'] < best['seconds']):
+                        best = result
+            except Skip as e:
+                report['skipped'][name] = str(e)
+                continue
+
+            report['results'].append(best)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return report
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark segmentation, export and fingerprinting')
+    parser.add_argument('--length', type=float, default=60,
+        help='seconds of synthetic audio')
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--sample-width', type=int, default=2,
+        choices=[1, 2, 3, 4])
+    parser.add_argument('--frame-rate', type=int, default=44100)
+    parser.add_argument('--song-length', type=float, default=20)
+    parser.add_argument('--silence-length', type=float, default=1)
+    parser.add_argument('--noise-floor', type=int, default=5,
+        help='peak of the noise in silences and songs')
+    parser.add_argument('--threshold', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=1,
+        help='runs of each benchmark, the fastest is reported')
+    parser.add_argument('--only', action='append',
+        help='run only this benchmark, can be repeated')
+    parser.add_argument('--json', metavar='PATH',
+        help="write the report as json, '-' for the standard output")
+    args = parser.parse_args(args)
+
+    report = run(args.length, args.channels, args.sample_width,
+        args.frame_rate, args.song_length, args.silence_length,
+        args.noise_floor, args.threshold, args.repeat, args.only)
+
+    if(args.json == '-'):
+        json.dump(report, sys.stdout, indent=2)
+        return
+    elif(args.json):
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    for r in report['results']:
+        print('{name:16} {seconds:8.3f}s {frames_per_sec:14.0f} frames/s '
+            '{mb_per_sec:8.2f} MB/s'.format(**r))
+    for name, reason in report['skipped'].items():
+        print('{:16} skipped: {}'.format(name, reason))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+from collections import namedtuple
+
+from Files import replace
+from Samples import energy, crossings
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+try:
+    import chromaprint
+except ImportError:
+    chromaprint = None
+
+
+MIN_WINDOWS = 20            #windows of a song before it can match another one, 10 seconds of 0.5 seconds
+FINGERPRINT_LENGTH = 120    #seconds of each song that are fingerprinted
+FINGERPRINT_ERRORS = 0.2    #max ratio of different bits of two fingerprints of the same song
+FINGERPRINT_OFFSET = 8      #max offset of two fingerprints, in items of about 0.12 seconds
+
+Signature = namedtuple('Signature', 'windows fingerprint')
+
+
+########################################################################
+# Utilities
+########################################################################
+def _bit_errors(a, b):
+    """Returns the lowest ratio of different bits of two fingerprints,
+    trying the offsets up to FINGERPRINT_OFFSET items
+    """
+
+    best = 1.0
+    for offset in range(-FINGERPRINT_OFFSET, FINGERPRINT_OFFSET + 1):
+        pairs = list(zip(a[max(offset, 0):], b[max(-offset, 0):]))
+        if(pairs):
+            errors = sum([bin((x ^ y) & 0xffffffff).count('1') for x, y in pairs])
+            best = min(best, errors / (32.0 * len(pairs)))
+    return best
+
+
+def similar(a, b, tolerance=0.05, min_windows=MIN_WINDOWS):
+    """Compares two signatures. Songs shorter than min_windows never
+    match. The lengths must differ in less than tolerance. If both songs
+    have a chromaprint fingerprint, they match when few of its bits
+    differ. Otherwise both the envelope and the zero crossing rate of
+    each window must differ on average in less than tolerance, allowing
+    an offset of up to two windows because the songs may not start
+    exactly at the same frame
+    """
+
+    longest = max(len(a.windows), len(b.windows))
+    if(min(len(a.windows), len(b.windows)) < max(min_windows, 1)):
+        return False
+    if(abs(len(a.windows) - len(b.windows)) > max(2, tolerance * longest)):
+        return False
+
+    if(a.fingerprint and b.fingerprint):
+        return _bit_errors(a.fingerprint, b.fingerprint) < FINGERPRINT_ERRORS
+
+    for lag in (0, -1, 1, -2, 2):
+        pairs = list(zip(a.windows[max(lag, 0):], b.windows[max(-lag, 0):]))
+        if(not pairs):
+            continue
+        levels = sum([abs(x[0] - y[0]) for x, y in pairs]) / len(pairs)
+        #the rate of a window is relative to the highest of both songs
+        rates = sum([abs(x[1] - y[1]) / max(x[1], y[1], 1e-9) for x, y in pairs]) / len(pairs)
+        if(levels < tolerance and rates < tolerance):
+            return True
+
+    return False
+
+
+########################################################################
+# Classes
+########################################################################
+class Envelope(object):
+    """Builds the signature of a song from the blocks of frames passed to
+    add, e.g. as the tap of an encoder. Each window of window seconds has
+    its RMS, normalized to the loudest window so the same song recorded
+    at a different level has the same signature, and its zero crossing
+    rate, which tells apart sounds with the same envelope but different
+    frequencies. If chromaprint is available the first
+    FINGERPRINT_LENGTH seconds are fingerprinted too
+    """
+
+    def __init__(self, sample_width, channels, frame_rate, window=0.5):
+        self.sample_width = sample_width
+        self.channels = channels
+        self.window_frames = max(int(window * frame_rate), 1)
+        self.frames = 0
+        self._frame_size = sample_width * channels
+        self._windows = []
+        self._energy = 0
+        self._samples = 0
+        self._crossings = 0
+        self._window_frames = 0
+
+        self._fingerprinter = None
+        self._fingerprint_frames = FINGERPRINT_LENGTH * frame_rate
+        if(chromaprint and (sample_width == 2 or audioop)):
+            try:
+                self._fingerprinter = chromaprint.Fingerprinter()
+                self._fingerprinter.start(frame_rate, channels)
+            except chromaprint.FingerprintError:
+                self._fingerprinter = None
+
+    def add(self, data):
+        if(self._fingerprinter and self.frames < self._fingerprint_frames):
+            self._fingerprint(data)
+
+        self.frames += len(data) // self._frame_size
+
+        #data is split at the end of each window, so the windows do not 
+        #depend on the size of the blocks
+        frame_size = self._frame_size
+        o = 0
+
+        while(o < len(data)):
+            size = min((self.window_frames - self._window_frames) * frame_size, 
+                len(data) - o)
+            block = data[o:o + size]
+            o += size
+
+            total, samples = energy(block, self.sample_width)
+            self._energy += total
+            self._samples += samples
+
+            count, frames = crossings(block, self.sample_width, self.channels)
+            self._crossings += count
+            self._window_frames += frames
+
+            if(self._window_frames >= self.window_frames):
+                self._close_window()
+
+    def _close_window(self):
+        self._windows.append(((self._energy / float(self._samples)) ** 0.5,
+            self._crossings / float(self._window_frames)))
+        self._energy = 0
+        self._samples = 0
+        self._crossings = 0
+        self._window_frames = 0
+
+    def signature(self):
+        fingerprint = None
+        if(self._fingerprinter):
+            try:
+                encoded = self._fingerprinter.finish()
+                fingerprint = tuple(chromaprint.decode_fingerprint(encoded)[0])
+            except chromaprint.FingerprintError:
+                pass
+            self._fingerprinter = None
+
+        loudest = max([w[0] for w in self._windows]) if(self._windows) else 0
+        windows = [(w[0] / loudest if(loudest) else 0, w[1]) for w in self._windows]
+        return Signature(tuple(windows), fingerprint)
+
+    def _fingerprint(self, data):
+        if(self.sample_width != 2):
+            try:
+                data = audioop.lin2lin(data, self.sample_width, 2)
+            except audioop.error:
+                #3-byte samples need python 3.4 or later
+                self._fingerprinter = None
+                return
+
+        try:
+            self._fingerprinter.feed(data)
+        except chromaprint.FingerprintError:
+            self._fingerprinter = None
+
+
+class Group(object):
+
+    def __init__(self, path, frames, signature):
+        self.path = path
+        self.frames = frames
+        self.signature = signature
+        self.copies = 1
+
+
+class DedupeIndex(object):
+    """Groups songs with similar signatures. The first song of a group is
+    its representative, the only one that should be identified. A
+    duplicate longer than the representative is the best copy, so it
+    replaces the representative file. With mode 'remove' duplicate files
+    are deleted, with 'link' they become hard links to the representative
+    (where hard links are not supported they are deleted too)
+    """
+
+    def __init__(self, mode='remove', tolerance=0.05):
+        if(mode not in ('remove', 'link')):
+            raise ValueError('mode must be remove or link')
+
+        self.mode = mode
+        self.tolerance = tolerance
+        self.groups = []
+        self._lock = threading.Lock()
+
+    def add(self, path, frames, signature):
+        """Adds an exported song. Returns None if it's the representative
+        of a new group, otherwise the path of the representative, and then
+        the song at path was already removed or linked
+        """
+
+        with self._lock:
+
+            for group in self.groups:
+                if(similar(signature, group.signature, self.tolerance)):
+                    break
+            else:
+                self.groups.append(Group(path, frames, signature))
+                return None
+
+            group.copies += 1
+
+            #keep the best copy with the name of the representative
+            if(frames > group.frames):
+                replace(path, group.path)
+                group.frames = frames
+                group.signature = signature
+            else:
+                os.remove(path)
+
+            if(self.mode == 'link' and hasattr(os, 'link')):
+                os.link(group.path, path)
+
+            return group.path
+
+    def rename(self, old, new):
+        """Renames a representative, e.g. after identifying it. It's done
+        while holding the lock, so a better copy can not replace it at the
+        same time
+        """
+
+        with self._lock:
+            os.rename(old, new)
+            for group in self.groups:
+                if(group.path == old):
+                    group.path = new
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import wave
+import errno
+import subprocess
+
+import Raudio
+from Raudio import chunklist_to_file, iter_chunklist
+import Metrics
+
+
+FLAC_COMMAND = 'flac'
+FLAC_ENVVAR = 'FLAC'
+
+
+########################################################################
+# Exceptions
+########################################################################
+class EncoderException(Raudio.BaseException):
+    pass
+
+
+class NoEncoderException(EncoderException):
+    pass
+
+
+########################################################################
+# Encoders
+########################################################################
+class WavStream(object):
+    """Wav file written block by block. The header is only updated when 
+    it's closed
+    """
+
+    def __init__(self, output_path, channels, sample_width, frame_rate):
+        self.path = output_path
+        self._audio = wave.open(output_path, 'wb')
+        self._audio.setnchannels(channels)
+        self._audio.setsampwidth(sample_width)
+        self._audio.setframerate(frame_rate)
+
+    def write(self, data):
+        self._audio.writeframesraw(data)
+
+    def close(self):
+        """Finalizes the file and returns its size
+        """
+        self._audio.close()
+        return os.path.getsize(self.path)
+
+    def abort(self):
+        """Closes and removes the file
+        """
+        self._audio.close()
+        os.remove(self.path)
+
+
+class FlacStream(object):
+    """Pipes the frames written to the flac command-line tool
+    """
+
+    def __init__(self, output_path, channels, sample_width, frame_rate, 
+        compression_level=5):
+
+        self.path = output_path
+
+        command = [
+            os.environ.get(FLAC_ENVVAR, FLAC_COMMAND),
+            '--silent', '--force',
+            '-{}'.format(compression_level),
+            '--force-raw-format', '--endian=little',
+            #8-bit wav samples are unsigned
+            '--sign={}'.format('unsigned' if sample_width == 1 else 'signed'),
+            '--channels={}'.format(channels),
+            '--bps={}'.format(sample_width * 8),
+            '--sample-rate={}'.format(frame_rate),
+            '-o', output_path, '-'
+        ]
+
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                self._proc = subprocess.Popen(command, stdin=subprocess.PIPE, 
+                    stderr=devnull)
+        except OSError as e:
+            if(e.errno == errno.ENOENT):
+                raise NoEncoderException('flac not found')
+            raise EncoderException('flac invocation failed: {}'.format(e))
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    def close(self):
+        """Waits for the encoder and returns the size of the file
+        """
+        self._proc.stdin.close()
+
+        retcode = self._proc.wait()
+        if(retcode):
+            raise EncoderException('flac exited with status {}'.format(retcode))
+
+        return os.path.getsize(self.path)
+
+    def abort(self):
+        """Stops the encoder and removes the file
+        """
+        self._proc.stdin.close()
+        self._proc.wait()
+        if(os.path.exists(self.path)):
+            os.remove(self.path)
+
+
+class WavEncoder(object):
+    """Writes the chunks as raw wav. It's the fastest encoder but the 
+    largest output
+    """
+
+    extension = 'wav'
+
+    def encode(self, output_path, chunklist, tap=None):
+        """Exports the chunks to output_path and returns the bytes written.
+        tap receives each block of frames
+        """
+        chunklist_to_file(output_path, chunklist, tap=tap)
+
+        size = os.path.getsize(output_path)
+        Metrics.count('export_encoded_bytes', size)
+        return size
+
+    def open(self, output_path, channels, sample_width, frame_rate):
+        """Returns a stream to write the frames of a song as they arrive
+        """
+        return WavStream(output_path, channels, sample_width, frame_rate)
+
+
+class FlacEncoder(object):
+    """Lossless compression with the flac command-line tool. The frames 
+    are piped to the encoder, so no intermediate wav is written. The 
+    compression level goes from 0 (fastest) to 8 (smallest)
+    """
+
+    extension = 'flac'
+
+    def __init__(self, compression_level=5):
+        if(compression_level not in range(9)):
+            raise EncoderException('Invalid compression level')
+
+        self.compression_level = compression_level
+
+    def encode(self, output_path, chunklist, tap=None):
+        """Exports the chunks to output_path and returns the bytes written.
+        tap receives each block of frames. Like the other encoders, 
+        export_bytes counts the frames read and export_encoded_bytes the
+        compressed output
+        """
+
+        with Metrics.timer('export'):
+            size = self._encode(output_path, chunklist, tap)
+
+        Metrics.count('export_encoded_bytes', size)
+        return size
+
+    def open(self, output_path, channels, sample_width, frame_rate):
+        """Returns a stream to write the frames of a song as they arrive
+        """
+        return FlacStream(output_path, channels, sample_width, frame_rate, 
+            self.compression_level)
+
+    def _encode(self, output_path, chunklist, tap):
+
+        first = chunklist[0]
+        stream = self.open(output_path, first.channels, first.sample_width, 
+            first.frame_rate)
+
+        try:
+            for data in iter_chunklist(chunklist):
+                stream.write(data)
+                Metrics.count('export_bytes', len(data))
+                if(tap):
+                    tap(data)
+        except Exception:
+            stream.abort()
+            raise
+
+        return stream.close()
+
+
+def make_encoder(name, compression_level=5):
+    """Returns the encoder for the given output format
+    """
+
+    if(name == 'wav'):
+        return WavEncoder()
+    elif(name == 'flac'):
+        return FlacEncoder(compression_level)
+
+    raise EncoderException('Unknown output format {}'.format(name))
+
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+
+
+def replace(source, destination):
+    """Renames source to destination, replacing it if it exists. It's
+    atomic except on windows with python 2, where os.rename can not
+    replace files, so the destination is removed first
+    """
+
+    if(hasattr(os, 'replace')):
+        os.replace(source, destination)
+        return
+
+    if(os.name == 'nt' and os.path.exists(destination)):
+        os.remove(destination)
+    os.rename(source, destination)
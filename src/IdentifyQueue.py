@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+
+from collections import namedtuple
+
+from Worker import Worker
+import Metrics
+
+try:
+    import acoustid
+except ImportError:
+    acoustid = None
+
+
+Job = namedtuple('Job', 'id path size source attempts')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    size INTEGER,
+    source TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_until REAL,
+    new_path TEXT,
+    title TEXT,
+    artist TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, not_before);
+"""
+
+
+########################################################################
+# Utilities
+########################################################################
+def identified_path(path, title, artist):
+    """Returns the path of a song renamed as 'artist - title'
+    """
+
+    extension = os.path.splitext(path)[1]
+    filename = u'{0} - {1}{2}'.format(artist, title, extension).replace('/', '')
+    return os.path.join(os.path.dirname(path), filename)
+
+
+########################################################################
+# Queue
+########################################################################
+class IdentifyQueue(object):
+    """Durable queue of exported songs waiting to be identified, stored
+    in a SQLite database at path. It survives restarts, and several
+    processes can put songs into the same database and consume it, e.g.
+    many recorders and a single IdentifyConsumer. A consumer claims jobs
+    for lease seconds, so the jobs of a consumer that died are claimed
+    again once their lease expires. Jobs go from 'pending' to 'claimed'
+    and then to 'done', back to 'pending' to be retried later, or to
+    'failed', from where requeue takes them back to 'pending'
+    """
+
+    def __init__(self, path, lease=300, timeout=30):
+        self.path = path
+        self.lease = lease
+        self.timeout = timeout
+
+        #sqlite connections can not be shared between threads
+        self._local = threading.local()
+
+        #executescript commits by itself
+        self._connection().executescript(_SCHEMA)
+
+    def put(self, path, size=None, source=None):
+        """Adds a song and returns the id of its job
+        """
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute('INSERT INTO jobs (path, size, source, '
+                'created, updated) VALUES (?, ?, ?, ?, ?)',
+                (os.path.abspath(path), size, source, now, now))
+            job_id = cursor.lastrowid
+
+        Metrics.count('identify_queue_put')
+        return job_id
+
+    def claim(self, owner, limit=1):
+        """Claims up to limit jobs that are ready, the oldest first.
+        Returns a list of Job
+        """
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute('SELECT id, path, size, source, attempts FROM '
+                'jobs WHERE (state = ? AND not_before <= ?) OR (state = ? '
+                'AND lease_until < ?) ORDER BY id LIMIT ?',
+                ('pending', now, 'claimed', now, limit)).fetchall()
+
+            db.executemany('UPDATE jobs SET state = ?, owner = ?, '
+                'lease_until = ?, updated = ? WHERE id = ?',
+                [('claimed', owner, now + self.lease, now, row[0]) for row in rows])
+
+        return [Job(*row) for row in rows]
+
+    def release(self, job_id):
+        """Returns a claimed job to the queue without counting an attempt
+        """
+        self._update(job_id, state='pending', owner=None, lease_until=None)
+
+    def done(self, job_id, new_path, title, artist):
+        self._update(job_id, state='done', new_path=new_path, title=title,
+            artist=artist, owner=None, lease_until=None)
+
+    def retry(self, job_id, error, delay, attempt=True):
+        """Makes the job ready again in delay seconds, counting a failed
+        attempt unless attempt is False
+        """
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET state = ?, attempts = attempts + ?, '
+                'not_before = ?, error = ?, owner = NULL, lease_until = NULL, '
+                'updated = ? WHERE id = ?',
+                ('pending', 1 if(attempt) else 0, time.time() + delay, error,
+                time.time(), job_id))
+
+    def fail(self, job_id, error):
+        self._update(job_id, state='failed', error=error, owner=None,
+            lease_until=None)
+
+    def requeue(self):
+        """Makes the failed jobs ready again, with no attempts. Returns
+        the number of jobs
+        """
+        with self._transaction() as db:
+            cursor = db.execute('UPDATE jobs SET state = ?, attempts = 0, '
+                'not_before = 0, owner = NULL, lease_until = NULL, updated = ? '
+                'WHERE state = ?', ('pending', time.time(), 'failed'))
+        return cursor.rowcount
+
+    def counts(self):
+        """Returns the number of jobs in each state
+        """
+        with self._transaction() as db:
+            rows = db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY '
+                'state').fetchall()
+        return dict(rows)
+
+    def ready(self):
+        """Returns the number of jobs that can be claimed now
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT COUNT(*) FROM jobs WHERE (state = ? AND '
+                'not_before <= ?) OR (state = ? AND lease_until < ?)',
+                ('pending', now, 'claimed', now)).fetchone()
+        return row[0]
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if(db is not None):
+            db.close()
+            self._local.db = None
+
+    def _update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        names = sorted(fields)
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET {} WHERE id = ?'.format(
+                ', '.join(['{} = ?'.format(n) for n in names])),
+                [fields[n] for n in names] + [job_id])
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if(db is None):
+            #transactions are started explicitly, see _transaction
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                isolation_level=None)
+            #readers do not block the writer of other processes
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+
+class _Transaction(object):
+    """Runs a block in a transaction that takes the write lock at the
+    start, so a claim can not race with the claim of another process
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if(exc_type is None):
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('ROLLBACK')
+
+
+########################################################################
+# Consumer
+########################################################################
+class IdentifyConsumer(Worker):
+    """Identifies the songs of an IdentifyQueue in the background and
+    renames them with the rename function. It claims up to batch_size
+    jobs at once and looks them up one by one, as fast as the AcoustID
+    rate limit allows. A lookup that fails with an error of the service
+    is retried after retry_delay seconds, doubled on each attempt up to
+    max_retry_delay, and the job fails after max_attempts. While the
+    service can not be reached, e.g. the circuit breaker of acoustid is
+    open, the jobs wait retry_delay seconds without counting attempts,
+    so an outage never fails them.
+    Songs without a match are done with no title. identified_callback
+    receives the job and the new path, title and artist of each
+    identified song. If drain is True the consumer stops once there are
+    no jobs ready, otherwise it polls the queue every poll_interval
+    seconds until it's stopped. Jobs waiting to be retried stay in the
+    queue for the next run
+    """
+
+    def __init__(self, queue, apikey, identified_callback=None,
+        rename=os.rename, batch_size=8, max_attempts=5, retry_delay=30,
+        max_retry_delay=3600, poll_interval=1, drain=False, owner=None):
+
+        Worker.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.apikey = apikey
+        self.identified_callback = identified_callback
+        self.rename = rename
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.draining = drain
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(),
+            os.getpid(), id(self))
+
+        #stats
+        self.identified = 0
+        self.unmatched = 0
+        self.retried = 0
+        self.postponed = 0
+        self.failed = 0
+
+        self._claimed = []
+
+    def drain(self):
+        """Stops the consumer once there are no jobs ready
+        """
+        self.draining = True
+
+    def loop(self):
+        self._claimed = self.queue.claim(self.owner, self.batch_size)
+
+        if(not self._claimed):
+            if(self.draining):
+                self.stop()
+            else:
+                self.sleep(self.poll_interval)
+            return
+
+        while(self._claimed and not self.isStopped()):
+            if(not self._process(self._claimed.pop(0))):
+                #the next lookups would fail too
+                for job in self._claimed:
+                    self.queue.retry(job.id, 'the service is unavailable',
+                        self.retry_delay, attempt=False)
+                self._claimed = []
+
+    def on_stop(self):
+        #the jobs claimed but not started are not left until the lease expires
+        for job in self._claimed:
+            self.queue.release(job.id)
+        self._claimed = []
+        self.queue.close()
+
+    def stats(self):
+        stats = {
+            'identified': self.identified,
+            'unmatched': self.unmatched,
+            'retried': self.retried,
+            'postponed': self.postponed,
+            'failed': self.failed,
+        }
+        stats.update(self.queue.counts())
+        return stats
+
+    def _process(self, job):
+        """Returns False if the service is unavailable
+        """
+        if(not os.path.exists(job.path)):
+            self.failed += 1
+            self.queue.fail(job.id, 'the song does not exist')
+            return True
+
+        try:
+            score, rid, title, artist = next(acoustid.match(self.apikey, job.path))
+        except StopIteration:
+            self.unmatched += 1
+            self.queue.done(job.id, job.path, None, None)
+            Metrics.count('identify_queue_unmatched')
+            return True
+        except acoustid.ServiceUnavailableError as e:
+            self.postponed += 1
+            self.queue.retry(job.id, str(e), self.retry_delay, attempt=False)
+            Metrics.count('identify_queue_postponed')
+            return False
+        except acoustid.WebServiceError as e:
+            self._retry(job, e)
+            return True
+        except Exception as e:
+            self.failed += 1
+            self.queue.fail(job.id, str(e))
+            Metrics.count('identify_queue_failed')
+            return True
+
+        path = identified_path(job.path, title, artist)
+        try:
+            self.rename(job.path, path)
+        except OSError:
+            path = job.path
+
+        self.identified += 1
+        self.queue.done(job.id, path, title, artist)
+        Metrics.count('identify_queue_identified')
+
+        if(callable(self.identified_callback)):
+            self.identified_callback(job, path, title, artist)
+        return True
+
+    def _retry(self, job, exception):
+        if(job.attempts + 1 >= self.max_attempts):
+            self.failed += 1
+            self.queue.fail(job.id, str(exception))
+            Metrics.count('identify_queue_failed')
+            return
+
+        self.retried += 1
+        delay = min(self.retry_delay * 2 ** job.attempts, self.max_retry_delay)
+        self.queue.retry(job.id, str(exception), delay)
+        Metrics.count('identify_queue_retries')
+
+
+########################################################################
+# Command line
+########################################################################
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Identify the songs of an identification queue')
+    parser.add_argument('queue', help='path of the queue database')
+    parser.add_argument('-k', '--apikey', required=True,
+        help='AcoustID API key')
+    parser.add_argument('--batch-size', type=int, default=8,
+        help='jobs claimed at once')
+    parser.add_argument('--max-attempts', type=int, default=5)
+    parser.add_argument('--retry-delay', type=float, default=30,
+        help='seconds before retrying a failed lookup, doubled each time')
+    parser.add_argument('--drain', action='store_true',
+        help='exit once there are no jobs ready instead of waiting for more')
+    parser.add_argument('--requeue-failed', action='store_true',
+        help='try the failed jobs again from the start')
+    args = parser.parse_args(args)
+
+    if(not acoustid):
+        sys.stderr.write('acoustid is not available\n')
+        return 1
+
+    def on_identified(job, path, title, artist):
+        print(u'{} -> {}'.format(job.path, path))
+
+    queue = IdentifyQueue(args.queue)
+    if(args.requeue_failed):
+        sys.stderr.write('{} failed jobs requeued\n'.format(queue.requeue()))
+
+    consumer = IdentifyConsumer(queue, args.apikey,
+        on_identified, batch_size=args.batch_size,
+        max_attempts=args.max_attempts, retry_delay=args.retry_delay,
+        drain=args.drain)
+    consumer.start()
+
+    try:
+        #wait with timeouts so Ctrl+C is not blocked
+        while(not consumer.wait(1)):
+            pass
+    except KeyboardInterrupt:
+        consumer.stop()
+        consumer.wait()
+
+    sys.stderr.write('{}\n'.format(consumer.stats()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
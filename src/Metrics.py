@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import time
+import logging
+import tempfile
+import threading
+
+from Worker import Worker
+from Files import replace
+
+
+#metrics are disabled by default, so the instrumented code only pays a
+#function call and a test
+enabled = False
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_reporter = None
+
+
+########################################################################
+# Recording
+########################################################################
+def count(name, value=1):
+    """Adds value to the counter name
+    """
+    if(not enabled):
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Records a duration of the timer name
+    """
+    if(not enabled):
+        return
+
+    with _lock:
+        timer = _timers.get(name)
+        if(timer is None):
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+
+class timer(object):
+    """Context manager that records the duration of its block
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.time() - self.start)
+
+
+def snapshot():
+    """Returns the current time, the counters and the timers. Each timer
+    is a tuple with the count, the total and the max duration
+    """
+    with _lock:
+        return {
+            'time': time.time(),
+            'counters': dict(_counters),
+            'timers': dict([(k, tuple(v)) for k, v in _timers.items()]),
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+########################################################################
+# Sinks
+########################################################################
+class CallbackSink(object):
+    """Passes each snapshot to callback
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, snapshot):
+        self.callback(snapshot)
+
+
+class LogSink(object):
+    """Logs a line with the counters, their rate per second since the
+    previous line, and the mean and max of the timers
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('raudian.metrics')
+        self.level = level
+        self._previous = None
+
+    def emit(self, snapshot):
+        previous = self._previous or {'time': snapshot['time'], 'counters': {}}
+        elapsed = snapshot['time'] - previous['time']
+        self._previous = snapshot
+
+        parts = []
+        for name, value in sorted(snapshot['counters'].items()):
+            delta = value - previous['counters'].get(name, 0)
+            rate = delta / elapsed if(elapsed) else 0.0
+            parts.append('{}={} ({:.1f}/s)'.format(name, value, rate))
+
+        for name, (n, total, longest) in sorted(snapshot['timers'].items()):
+            parts.append('{}={}x{:.3f}s (max {:.3f}s)'.format(name, n,
+                total / n, longest))
+
+        self.logger.log(self.level, ' '.join(parts))
+
+
+class PrometheusSink(object):
+    """Writes the metrics in the Prometheus text format to path, e.g. for
+    the textfile collector of the node exporter. The file is replaced
+    atomically
+    """
+
+    def __init__(self, path, prefix='raudian_'):
+        self.path = path
+        self.prefix = prefix
+
+    def emit(self, snapshot):
+        lines = []
+
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = '{}{}_total'.format(self.prefix, name)
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {}'.format(metric, value))
+
+        for name, (n, total, longest) in sorted(snapshot['timers'].items()):
+            metric = '{}{}_seconds'.format(self.prefix, name)
+            lines.append('# TYPE {} summary'.format(metric))
+            lines.append('{}_count {}'.format(metric, n))
+            lines.append('{}_sum {}'.format(metric, total))
+            lines.append('# TYPE {}_max gauge'.format(metric))
+            lines.append('{}_max {}'.format(metric, longest))
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        replace(temp, self.path)
+
+
+class Reporter(Worker):
+    """Emits a snapshot to every sink each interval seconds, and once
+    more when it's stopped
+    """
+
+    def __init__(self, sinks, interval=10):
+        Worker.__init__(self)
+        self.daemon = True
+        self.sinks = sinks
+        self.interval = interval
+
+    def loop(self):
+        if(not self.sleep(self.interval)):
+            self.emit()
+
+    def on_stop(self):
+        self.emit()
+
+    def emit(self):
+        s = snapshot()
+        for sink in self.sinks:
+            sink.emit(s)
+
+
+def start(sinks=None, interval=10):
+    """Enables the metrics and, if there are sinks, starts reporting
+    them every interval seconds
+    """
+    global enabled, _reporter
+
+    enabled = True
+
+    if(sinks):
+        _reporter = Reporter(sinks, interval)
+        _reporter.start()
+
+
+def stop():
+    """Disables the metrics after the last report
+    """
+    global enabled, _reporter
+
+    if(_reporter):
+        _reporter.stop()
+        _reporter.wait()
+        _reporter = None
+
+    enabled = False
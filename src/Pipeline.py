@@ -0,0 +1,1202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import threading
+import logging
+import argparse
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from collections import namedtuple, OrderedDict
+
+from Raudio import Chunk, FromStream, SongAssembler, SongWriter, LevelMeter, open_input
+from Encoder import make_encoder
+from Dedupe import Envelope, DedupeIndex
+from IdentifyQueue import IdentifyQueue, IdentifyConsumer, identified_path
+from Worker import Worker
+from Files import replace
+import Metrics
+
+try:
+    import acoustid
+except ImportError:
+    acoustid = None
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+#marks the end of the items of a queue
+_END = object()
+
+Song = namedtuple('Song', 'path size title artist duplicate_of source')
+
+
+########################################################################
+# Utilities
+########################################################################
+def identify(apikey, path, rename=os.rename):
+    """Looks up the song in AcoustID and renames it as 'artist - title'
+    with the rename function. Returns the new path, the title and the
+    artist, or the same path and None if the song could not be identified
+    """
+
+    try:
+        score, rid, title, artist = next(acoustid.match(apikey, path))
+    except Exception:
+        return path, None, None
+
+    new_path = identified_path(path, title, artist)
+
+    try:
+        rename(path, new_path)
+    except OSError:
+        return path, title, artist
+
+    return new_path, title, artist
+
+
+########################################################################
+# Stages
+########################################################################
+class StageWorker(Worker):
+
+    def __init__(self, stage):
+        Worker.__init__(self)
+        self.stage = stage
+
+    def loop(self):
+
+        item = self.stage.queue.get()
+
+        #the previous stage finished
+        if(item is _END):
+            self.stop()
+            return
+
+        start = time.time()
+        try:
+            result = self.stage.function(item)
+        except Exception as e:
+            self.stage._failed(item, e)
+            return
+
+        self.stage._done(result, time.time() - start)
+
+    def on_stop(self):
+        self.stage._worker_finished()
+
+
+class Stage(object):
+    """Runs function over the items of a bounded queue on its own worker
+    threads. The result of function is put into the next stage unless
+    it's None. put blocks while the queue is full, so a slow stage slows
+    down the previous ones instead of accumulating items (backpressure).
+    finish is called once all the items were processed, before closing
+    the next stage
+    """
+
+    def __init__(self, name, function, workers=1, queue_size=16,
+        finish=None, error_callback=None):
+
+        self.name = name
+        self.function = function
+        self.finish = finish
+        self.error_callback = error_callback
+        self.next = None
+        self.queue = Queue.Queue(queue_size)
+        self.workers = [StageWorker(self) for i in range(workers)]
+
+        #stats
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.max_queue_depth = 0
+        self.start_time = None
+
+        self._running = workers
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.start_time = time.time()
+        for w in self.workers:
+            w.start()
+
+    def put(self, item):
+        self.queue.put(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def close(self):
+        """No more items will be put. The workers process the queued
+        items and stop
+        """
+        for w in self.workers:
+            self.queue.put(_END)
+
+    def join(self, timeout=None):
+        deadline = None if(timeout is None) else time.time() + timeout
+
+        for w in self.workers:
+            remaining = None if(deadline is None) else max(deadline - time.time(), 0)
+            if(not w.wait(remaining)):
+                return False
+
+        return True
+
+    def stats(self):
+        elapsed = time.time() - self.start_time if(self.start_time) else 0
+        return {
+            'workers': len(self.workers),
+            'processed': self.processed,
+            'errors': self.errors,
+            'throughput': self.processed / elapsed if(elapsed) else 0.0,
+            'busy_time': self.busy_time,
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+    def _done(self, result, elapsed):
+        with self._lock:
+            self.processed += 1
+            self.busy_time += elapsed
+
+        if(result is not None and self.next):
+            self.next.put(result)
+
+    def _failed(self, item, exception):
+        with self._lock:
+            self.errors += 1
+
+        if(callable(self.error_callback)):
+            self.error_callback(self.name, item, exception)
+
+    def _worker_finished(self):
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+
+        if(last):
+            if(callable(self.finish)):
+                self.finish()
+            if(self.next):
+                self.next.close()
+
+
+class CaptureWorker(Worker):
+    """Reads blocks of block_size frames from a wave-like reader and puts
+    them into a bounded queue, that QueueReader reads from the
+    segmentation thread. If the segmentation dies, abort stops the
+    capture, which would otherwise wait forever for room in the queue
+    """
+
+    def __init__(self, reader, block_size=4096, queue_size=64):
+        Worker.__init__(self)
+        self.reader = reader
+        self.block_size = block_size
+        self.queue = Queue.Queue(queue_size)
+
+        #the reader has no more frames
+        self.exhausted = False
+
+        #nobody reads the queue anymore
+        self.aborted = False
+
+        #stats
+        self.blocks = 0
+        self.frames = 0
+        self.max_queue_depth = 0
+        self.start_time = None
+
+    def on_start(self):
+        self.start_time = time.time()
+
+    def loop(self):
+
+        data = self.reader.readframes(self.block_size)
+
+        if(not data):
+            self.exhausted = True
+            self.stop()
+            return
+
+        if(not self._put(data)):
+            return
+        self.blocks += 1
+        self.frames += len(data) // (self.reader.getnchannels() * self.reader.getsampwidth())
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def stop(self):
+        Worker.stop(self)
+
+        #wake up the reader if it's waiting for frames
+        if(hasattr(self.reader, 'interrupt')):
+            self.reader.interrupt()
+
+    def on_stop(self):
+        self._put(_END)
+
+    def abort(self):
+        """Stops the capture and drops the queued blocks
+        """
+        self.aborted = True
+        self.stop()
+
+        while(True):
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+    def stats(self):
+        elapsed = time.time() - self.start_time if(self.start_time) else 0
+        return {
+            'workers': 1,
+            'processed': self.blocks,
+            'frames': self.frames,
+            'throughput': self.frames / elapsed if(elapsed) else 0.0,
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+    def _put(self, item):
+        """Waits for room in the queue unless the capture is aborted.
+        Returns False if item was dropped
+        """
+        while(not self.aborted):
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+
+class QueueReader(object):
+    """Wave-like reader over the blocks captured by a CaptureWorker.
+    readframes returns whole blocks, that's enough for the streaming
+    segmentation
+    """
+
+    def __init__(self, capture):
+        self.capture = capture
+        self._eof = False
+
+    def getnchannels(self):
+        return self.capture.reader.getnchannels()
+
+    def getsampwidth(self):
+        return self.capture.reader.getsampwidth()
+
+    def getframerate(self):
+        return self.capture.reader.getframerate()
+
+    def readframes(self, nframes):
+        if(self._eof):
+            return b''
+
+        data = self.capture.queue.get()
+        if(data is _END):
+            self._eof = True
+            return b''
+
+        return data
+
+    def close(self):
+        self.capture.reader.close()
+
+
+########################################################################
+# Checkpoints
+########################################################################
+class Checkpoint(object):
+    """Progress of a pipeline over a file, saved as json so a run that
+    died can be resumed. frame is the first frame of the source not
+    given to the assembler yet, pending are the chunks of the song in
+    progress, in_flight the songs assembled but not finished (with their
+    path once exported) and songs the finished ones. The checkpoint is
+    ignored if the source file changed, and deleted once the whole file
+    was processed and every song finished, so the same file can be
+    processed again from the start
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+        stat = os.stat(source)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+
+        self.frame = 0
+        self.pending = []
+        self.in_flight = OrderedDict()
+        self.songs = []
+        self.next_id = 0
+        self.finished = False
+
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Restores the saved state. Returns False if there is no
+        checkpoint for the source
+        """
+
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        if((state['source'], state['size'], state['mtime']) !=
+            (self.source, self.size, self.mtime)):
+            return False
+
+        #e.g. left by a run that could not delete it
+        if(state['finished'] and not state['in_flight']):
+            return False
+
+        self.frame = state['frame']
+        self.pending = [Chunk(*c) for c in state['pending']]
+        self.in_flight = OrderedDict()
+        for song in state['in_flight']:
+            song['chunks'] = [Chunk(*c) for c in song['chunks']]
+            self.in_flight[song['id']] = song
+        self.songs = state['songs']
+        self.next_id = state['next_id']
+        self.finished = state['finished']
+
+        return True
+
+    def save(self):
+        """Writes the state atomically, so a crash while saving keeps the
+        previous checkpoint
+        """
+
+        with self._lock:
+            #a finished run has nothing to resume
+            if(self.finished and not self.in_flight):
+                if(os.path.exists(self.path)):
+                    os.remove(self.path)
+                return
+
+            state = {
+                'source': self.source,
+                'size': self.size,
+                'mtime': self.mtime,
+                'frame': self.frame,
+                'pending': [list(c) for c in self.pending],
+                'in_flight': [dict(song, chunks=[list(c) for c in song['chunks']])
+                    for song in self.in_flight.values()],
+                'songs': list(self.songs),
+                'next_id': self.next_id,
+                'finished': self.finished,
+            }
+            data = json.dumps(state)
+
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(data)
+
+            replace(temp, self.path)
+
+    def advance(self, frames, pending, songs=()):
+        """Moves the progress frames forward, with the chunks of the song
+        in progress and the songs that those frames ended, in a single
+        step, so a checkpoint never has the same chunks in pending and in
+        a song. Returns the ids of the songs
+        """
+        with self._lock:
+            song_ids = []
+            for chunks in songs:
+                song_id = self.next_id
+                self.next_id += 1
+                self.in_flight[song_id] = {'id': song_id, 'chunks': chunks,
+                    'path': None, 'size': None}
+                song_ids.append(song_id)
+
+            self.frame += frames
+            self.pending = list(pending)
+        return song_ids
+
+    def exported(self, song_id, path, size):
+        with self._lock:
+            self.in_flight[song_id].update(path=path, size=size)
+        self.save()
+
+    def drop(self, song_id):
+        with self._lock:
+            del self.in_flight[song_id]
+        self.save()
+
+    def identified(self, song_id, song):
+        with self._lock:
+            del self.in_flight[song_id]
+            self.songs.append(song._asdict())
+        self.save()
+
+
+########################################################################
+# Pipeline
+########################################################################
+class Source(object):
+    """A source of a CaptureManager. It runs capture -> segment ->
+    assemble on its own threads, with its own segmentation state and
+    checkpoint, and puts the assembled songs into the stages shared by
+    all the sources. name is used instead of 'unknown' in the files of
+    the songs that were not identified
+    """
+
+    def __init__(self, manager, source, name=None, threshold=None,
+        checkpoint=None):
+
+        self.manager = manager
+        self.source = source
+        self.name = name
+        self.threshold = manager.threshold if(threshold is None) else threshold
+        self.checkpoint_path = checkpoint
+        self.checkpoint = None
+        self.reader = None
+        self.chunks = 0
+        self.songs = 0
+        self.resumed = False
+        self.segment_start_time = None
+
+        self._next_id = 0
+        self._last_save = time.time()
+        self._ended = []
+
+        #spill segments referenced by the songs not exported yet
+        self._spill_refs = {}
+        self._spill_lock = threading.Lock()
+        self._assembling = None
+        self._assembled = False
+
+    def start(self):
+        manager = self.manager
+
+        if(hasattr(self.source, 'readframes')):
+            reader, path = self.source, None
+        else:
+            reader, path = open_input(self.source)
+        self.reader = reader
+
+        if(self.checkpoint_path):
+            #the chunks of other sources reference temporary spill files
+            if(path is None):
+                reader.close()
+                raise ValueError('Checkpoints need a wav file source')
+            if(manager.incremental):
+                raise ValueError('Songs written incrementally can not be resumed')
+
+            self.checkpoint = Checkpoint(self.checkpoint_path, self.source)
+            self.resumed = self.checkpoint.load()
+            if(self.checkpoint.frame):
+                reader.setpos(self.checkpoint.frame)
+
+        threshold = self.threshold
+        if(threshold is not None and not isinstance(threshold, (tuple, list))):
+            threshold = (threshold,) * reader.getnchannels()
+
+        self.assembler = SongAssembler(self._on_song,
+            max_silence_length=manager.max_silence_length,
+            min_song_length=manager.min_song_length,
+            max_song_length=manager.max_song_length,
+            split_window=manager.split_window)
+        self.assemble = Stage('assemble', self._assemble, 1,
+            manager.queue_size, finish=self._finish_assembly,
+            error_callback=manager.error_callback)
+
+        self.capture = CaptureWorker(reader, manager.block_size,
+            manager.capture_queue_size)
+
+        #songs are written by the segmentation instead of the export stage
+        writer = None
+        if(manager.incremental):
+            analyzer = None
+            if(manager.dedupe_index):
+                analyzer = lambda: Envelope(reader.getsampwidth(),
+                    reader.getnchannels(), reader.getframerate())
+            writer = SongWriter(manager.encoder, manager.output_directory,
+                self._on_written, manager.max_silence_length,
+                manager.min_song_length, self.name or 'unknown', analyzer,
+                manager.max_song_length, manager.split_window)
+
+        self.meter = None
+        if(manager.level_rate):
+            self.meter = LevelMeter(manager.level_rate,
+                callback=self._on_levels)
+
+        #chunks reference the source when it can be read again, and then
+        #it's scanned coarse to fine
+        offset = self.checkpoint.frame if(self.checkpoint) else 0
+        self.segment = FromStream(QueueReader(self.capture), threshold,
+            update_callback=self._on_chunk,
+            stop_callback=self._segment_finished, path=path, offset=offset,
+            analysis_rate=manager.analysis_rate, writer=writer,
+            meter=self.meter, max_silence_length=manager.max_silence_length,
+            remove_spill=False)
+
+        self.segment_start_time = time.time()
+        self.assemble.start()
+
+        if(self.checkpoint):
+            self._resume()
+
+        self.segment.start()
+        self.capture.start()
+
+    def stop(self):
+        self.capture.stop()
+
+    def join(self, timeout=None):
+        deadline = None if(timeout is None) else time.time() + timeout
+
+        #the errors of the segmentation were reported by _segment_finished
+        for worker in (self.capture, self.segment):
+            remaining = None if(deadline is None) else max(deadline - time.time(), 0)
+            worker.join(remaining)
+            if(worker.is_alive()):
+                return False
+
+        if(self.capture.exc_info):
+            raise self.capture.exc_info[1]
+
+        remaining = None if(deadline is None) else max(deadline - time.time(), 0)
+        return self.assemble.join(remaining)
+
+    def stats(self):
+        """Returns the stats of capture, segment and assemble. The
+        capture stats include the overflows of the reader, if it counts
+        them like SystemInput
+        """
+
+        elapsed = time.time() - self.segment_start_time
+        stats = OrderedDict()
+        stats['capture'] = self.capture.stats()
+        stats['capture']['input_overflows'] = getattr(self.reader, 'input_overflows', 0)
+        stats['capture']['overruns'] = getattr(self.reader, 'overruns', 0)
+        stats['segment'] = {
+            'workers': 1,
+            'processed': self.chunks,
+            'throughput': self.chunks / elapsed if(elapsed) else 0.0,
+        }
+        stats['assemble'] = self.assemble.stats()
+        stats['assemble']['songs'] = self.songs
+
+        return stats
+
+    def levels(self):
+        """Returns the last Levels of the source (see LevelMeter), or None
+        if the manager has no level_rate
+        """
+        meter = getattr(self, 'meter', None)
+        return meter.snapshot if(meter) else None
+
+    def _resume(self):
+        """Restores the song in progress and sends the unfinished songs
+        to the stage they were in
+        """
+
+        self.assembler.chunks = list(self.checkpoint.pending)
+
+        for song_id, song in list(self.checkpoint.in_flight.items()):
+            if(song['path'] and os.path.exists(song['path'])):
+                self.manager.identify.put((self, song_id, song['path'],
+                    song['size']))
+            elif(all([os.path.exists(c.path) for c in song['chunks']])):
+                self.manager.export.put((self, song_id, song['chunks']))
+            else:
+                #it can not be exported again, it would never finish
+                self.checkpoint.drop(song_id)
+
+    def _segment_finished(self):
+        if(self.segment.exc_info):
+            #the capture would wait forever for the blocks to be read
+            self.capture.abort()
+            if(callable(self.manager.error_callback)):
+                self.manager.error_callback('segment', None,
+                    self.segment.exc_info[1])
+
+        self.assemble.close()
+
+    def _on_chunk(self, chunk):
+        self.chunks += 1
+        if(not self.manager.incremental):
+            self.assemble.put(chunk)
+
+    def _assemble(self, chunk):
+        #the chunks still queued are in this segment or the next ones
+        if(chunk.path != self._assembling):
+            self._assembling = chunk.path
+            self._discard_spill()
+
+        self.assembler.add(chunk)
+        self._send_songs(chunk.size)
+
+        if(self.checkpoint):
+            if(time.time() - self._last_save > self.manager.checkpoint_interval):
+                self.checkpoint.save()
+                self._last_save = time.time()
+
+    def _on_song(self, chunks):
+        with self._spill_lock:
+            for path in set([c.path for c in chunks]):
+                self._spill_refs[path] = self._spill_refs.get(path, 0) + 1
+
+        #sent once the assembler returns, see _send_songs
+        self._ended.append(chunks)
+
+    def _send_songs(self, frames):
+        """Registers the songs ended by the last frames together with the
+        progress, then puts them into the export stage, which may block
+        while other stages save the checkpoint
+        """
+
+        songs, self._ended = self._ended, []
+
+        if(self.checkpoint):
+            song_ids = self.checkpoint.advance(frames, self.assembler.chunks, songs)
+        else:
+            song_ids = range(self._next_id, self._next_id + len(songs))
+            self._next_id += len(songs)
+
+        for song_id, chunks in zip(song_ids, songs):
+            self.songs += 1
+            self.manager.export.put((self, song_id, chunks))
+
+    def _exported(self, chunks):
+        with self._spill_lock:
+            for path in set([c.path for c in chunks]):
+                if(self._spill_refs.get(path, 0) > 1):
+                    self._spill_refs[path] -= 1
+                else:
+                    self._spill_refs.pop(path, None)
+
+        #the assembler is idle once it finished
+        if(self._assembled):
+            self._discard_spill()
+
+    def _discard_spill(self):
+        """Deletes the spill segments that no chunk references anymore,
+        so the temporary files of a source that is never read again do
+        not pile up. Called from the assemble thread, or once it finished
+        """
+
+        spill = getattr(self.segment, 'spill', None)
+        if(not hasattr(spill, 'discard')):
+            return
+
+        with self._spill_lock:
+            keep = set(self._spill_refs)
+        keep.update([c.path for c in self.assembler.chunks])
+        keep.add(self._assembling)
+        spill.discard(keep)
+
+    def _on_levels(self, levels):
+        if(callable(self.manager.level_callback)):
+            self.manager.level_callback(self.name, levels)
+
+    def _on_written(self, path, size, envelope):
+        song_id = self._next_id
+        self._next_id += 1
+
+        #the song skips the export stage
+        self.songs += 1
+        self.manager.export.next.put((self, song_id, path, size, envelope))
+
+    def _finish_assembly(self):
+        try:
+            #a stopped run keeps the song in progress to resume it later
+            if(self.checkpoint and not self.capture.exhausted):
+                self.checkpoint.save()
+                return
+
+            self.assembler.flush()
+            if(self.checkpoint):
+                self.checkpoint.finished = True
+            self._send_songs(0)
+
+            self._assembling = None
+            self._assembled = True
+            self._discard_spill()
+
+            if(self.checkpoint):
+                self.checkpoint.save()
+        finally:
+            self.manager._source_finished(self)
+
+
+class CaptureManager(object):
+    """Extracts the songs of several sources at the same time in a
+    single process. Each source has its own capture, segmentation and
+    assembly (see Source), and the songs of all of them go through the
+    same stages: export -> [dedupe] -> identify. So the sources share
+    the export and identify workers, the AcoustID rate limit and lookup
+    cache, and the dedupe index. Sources can be added while the others
+    are running. The Song passed to song_callback has the name of its
+    source. stop_callback is called when every source finished and the
+    shared stages are empty. See Pipeline for the rest of the arguments
+    """
+
+    def __init__(self, output_directory, threshold=None, encoder=None,
+        apikey=None, song_callback=None, stop_callback=None,
+        error_callback=None, max_silence_length=0.2, min_song_length=1,
+        block_size=4096, capture_queue_size=64, queue_size=16,
+        export_workers=2, identify_workers=1, checkpoint_interval=30,
+        dedupe=None, dedupe_tolerance=0.05, analysis_rate=None,
+        incremental=False, identify_queue=None, identified_callback=None,
+        max_song_length=None, split_window=30, level_rate=None,
+        level_callback=None):
+
+        self.output_directory = output_directory
+        self.threshold = threshold
+        self.encoder = encoder or make_encoder('wav')
+        self.apikey = apikey
+        self.song_callback = song_callback
+        self.stop_callback = stop_callback
+        self.error_callback = error_callback
+        self.max_silence_length = max_silence_length
+        self.min_song_length = min_song_length
+        self.block_size = block_size
+        self.capture_queue_size = capture_queue_size
+        self.queue_size = queue_size
+        self.export_workers = export_workers
+        self.identify_workers = identify_workers
+        self.checkpoint_interval = checkpoint_interval
+        self.dedupe_index = DedupeIndex(dedupe, dedupe_tolerance) if(dedupe) else None
+        self.analysis_rate = analysis_rate
+        self.incremental = incremental
+        if(isinstance(identify_queue, basestring)):
+            identify_queue = IdentifyQueue(identify_queue)
+        self.identify_queue = identify_queue
+        self.identified_callback = identified_callback
+        self.max_song_length = max_song_length
+        self.split_window = split_window
+        self.level_rate = level_rate
+        self.level_callback = level_callback
+        self.consumer = None
+        self.sources = []
+        self.started = False
+
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def add_source(self, source, name=None, threshold=None, checkpoint=None):
+        """Adds a source, with its own threshold and checkpoint if given
+        (see Pipeline). If the manager is running the source starts
+        right away. Returns the Source
+        """
+
+        with self._lock:
+            if(name is not None and name in [s.name for s in self.sources]):
+                raise ValueError('There is already a source named {}'.format(name))
+
+            #the shared stages are closed once every source finished
+            if(self.started and not self._running):
+                raise ValueError('The capture already finished')
+
+            s = Source(self, source, name, threshold, checkpoint)
+            self.sources.append(s)
+
+            if(not self.started):
+                return s
+            self._running += 1
+
+        self._start_sources([s])
+        return s
+
+    def start(self):
+        if(not self.sources):
+            raise ValueError('There are no sources')
+
+        #build the stages from the last one
+        self.identify = Stage('identify', self._identify,
+            self.identify_workers, self.queue_size,
+            finish=self._finish, error_callback=self.error_callback)
+
+        self.export = Stage('export', self._export, self.export_workers,
+            self.queue_size, error_callback=self.error_callback)
+        self.export.next = self.identify
+
+        if(self.dedupe_index):
+            self.dedupe = Stage('dedupe', self._dedupe, 1, self.queue_size,
+                error_callback=self.error_callback)
+            self.dedupe.next = self.identify
+            self.export.next = self.dedupe
+
+        for stage in self._stages():
+            stage.start()
+
+        if(self.identify_queue and self.apikey and acoustid):
+            rename = self.dedupe_index.rename if(self.dedupe_index) else os.rename
+            self.consumer = IdentifyConsumer(self.identify_queue, self.apikey,
+                self._identified, rename)
+            self.consumer.start()
+
+        with self._lock:
+            self.started = True
+            self._running = len(self.sources)
+            sources = list(self.sources)
+
+        self._start_sources(sources)
+
+    def stop(self, name=None):
+        """Stops the capture of the source name, or of every source. The
+        audio already captured goes through the rest of the stages
+        """
+        for source in list(self.sources):
+            if(name is None or source.name == name):
+                source.stop()
+
+    def join(self, timeout=None):
+        """Waits for all the sources and stages, and for the identify
+        consumer to drain the queue. Returns False if some of them is
+        still running after timeout seconds
+        """
+        deadline = None if(timeout is None) else time.time() + timeout
+
+        for source in list(self.sources):
+            remaining = None if(deadline is None) else max(deadline - time.time(), 0)
+            if(not source.join(remaining)):
+                return False
+
+        for stage in self._stages():
+            remaining = None if(deadline is None) else max(deadline - time.time(), 0)
+            if(not stage.join(remaining)):
+                return False
+
+        if(self.consumer):
+            remaining = None if(deadline is None) else max(deadline - time.time(), 0)
+            return self.consumer.wait(remaining)
+
+        return True
+
+    def stats(self):
+        """Returns the stats of each source, by name or as sourceN if it
+        has no name, and of each shared stage. The throughput of capture
+        is in frames per second, the rest in items per second
+        """
+
+        stats = OrderedDict()
+        stats['sources'] = OrderedDict()
+        for i, source in enumerate(list(self.sources)):
+            if(source.segment_start_time):
+                key = 'source{}'.format(i) if(source.name is None) else source.name
+                stats['sources'][key] = source.stats()
+
+        for stage in self._stages():
+            stats[stage.name] = stage.stats()
+
+        if(self.consumer):
+            stats['identify_queue'] = self.consumer.stats()
+
+        return stats
+
+    def levels(self):
+        """Returns the last Levels of each source by name, or as sourceN
+        if it has no name (see Source.levels)
+        """
+        levels = OrderedDict()
+        for i, source in enumerate(list(self.sources)):
+            key = 'source{}'.format(i) if(source.name is None) else source.name
+            levels[key] = source.levels()
+        return levels
+
+    def _stages(self):
+        if(self.dedupe_index):
+            return [self.export, self.dedupe, self.identify]
+        return [self.export, self.identify]
+
+    def _start_sources(self, sources):
+        for i, source in enumerate(sources):
+            try:
+                source.start()
+            except Exception:
+                #they will never finish by themselves
+                for s in sources[i:]:
+                    self._source_finished(s)
+                raise
+
+    def _source_finished(self, source):
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+
+        if(last):
+            self.export.close()
+
+    def _export(self, song):
+        source, song_id, chunks = song
+        filename = '{}_{}.{}'.format(source.name or 'unknown', time.time(),
+            self.encoder.extension)
+        path = os.path.join(self.output_directory, filename)
+
+        #the signature for dedupe is computed while the song is exported
+        envelope = None
+        try:
+            if(self.dedupe_index):
+                envelope = Envelope(chunks[0].sample_width, chunks[0].channels,
+                    chunks[0].frame_rate)
+                size = self.encoder.encode(path, chunks, tap=envelope.add)
+            else:
+                size = self.encoder.encode(path, chunks)
+        finally:
+            source._exported(chunks)
+
+        if(source.checkpoint):
+            source.checkpoint.exported(song_id, path, size)
+
+        return source, song_id, path, size, envelope
+
+    def _dedupe(self, exported):
+        source, song_id, path, size, envelope = exported
+
+        representative = self.dedupe_index.add(path, envelope.frames,
+            envelope.signature())
+        if(representative is None):
+            return source, song_id, path, size
+
+        self._done(source, song_id,
+            Song(path, size, None, None, representative, source.name))
+
+    def _identify(self, exported):
+        source, song_id, path, size = exported[:4]
+        title = artist = None
+
+        #the song is identified later by a consumer of the queue
+        if(self.identify_queue):
+            self.identify_queue.put(path, size, source.name)
+        elif(self.apikey and acoustid):
+            rename = self.dedupe_index.rename if(self.dedupe_index) else os.rename
+            path, title, artist = identify(self.apikey, path, rename)
+
+        self._done(source, song_id,
+            Song(path, size, title, artist, None, source.name))
+
+    def _done(self, source, song_id, song):
+        if(source.checkpoint):
+            source.checkpoint.identified(song_id, song)
+
+        if(callable(self.song_callback)):
+            self.song_callback(song)
+
+    def _identified(self, job, path, title, artist):
+        if(callable(self.identified_callback)):
+            self.identified_callback(Song(path, job.size, title, artist,
+                None, job.source))
+
+    def _finish(self):
+        #the songs that can be identified now are, the rest wait in the queue
+        if(self.consumer):
+            self.consumer.drain()
+
+        if(callable(self.stop_callback)):
+            self.stop_callback()
+
+
+class Pipeline(CaptureManager):
+    """Extracts the songs of a source in stages connected by bounded
+    queues: capture -> segment -> assemble -> export -> identify. Each
+    stage runs on its own threads, so a slow export or identification
+    never stalls the capture, and the export and identify stages can run
+    several workers. source can be anything accepted by open_input or a
+    wave-like reader, e.g. SystemInput. threshold can be a tuple with
+    one value per channel or a number for all channels. song_callback
+    receives a Song for each exported song, from the identify threads.
+    stop_callback is called when every stage finished. If checkpoint is
+    the path of a file, the progress over a file source is saved there
+    every checkpoint_interval seconds and after each song, and a new
+    pipeline with the same checkpoint resumes from it without exporting
+    or identifying the finished songs again. If dedupe is 'remove' or
+    'link', songs similar to a previous one are grouped (see DedupeIndex)
+    and only the representative of each group is identified. If
+    analysis_rate is given, the silence detection of sources with a
+    higher frame rate skips frames to analyze about analysis_rate frames
+    per second. The songs are exported with every frame. Otherwise wav
+    files are scanned coarse to fine (see FromStream). If incremental
+    is True, the songs are written while they are captured (see
+    SongWriter) instead of being exported once they end, so the audio is
+    not read again. It can not be used with checkpoints. If
+    identify_queue is an IdentifyQueue or the path of its database, the
+    identify stage only puts the songs into it, so it never waits for
+    the network, and they are identified in the background by an
+    IdentifyConsumer if there is an apikey (or by another process
+    consuming the same queue). The Song passed to song_callback has no
+    title then, and identified_callback receives a Song for each song
+    identified later. If max_song_length is given, songs that reach it
+    without a silence, e.g. a continuous mix, are split at the quietest
+    moment of their last split_window seconds (see SongAssembler), so
+    the memory and the temporary files of a never-ending sound are
+    bounded and its songs are exported while it goes on. If level_rate
+    is given, the segmentation publishes level_rate times per second the
+    peak and RMS levels of the audio it reads (see LevelMeter), which
+    levels returns and level_callback receives with the name of the
+    source, from the segmentation thread
+    """
+
+    def __init__(self, source, output_directory, threshold=None,
+        encoder=None, apikey=None, song_callback=None, stop_callback=None,
+        error_callback=None, max_silence_length=0.2, min_song_length=1,
+        block_size=4096, capture_queue_size=64, queue_size=16,
+        export_workers=2, identify_workers=1, checkpoint=None,
+        checkpoint_interval=30, dedupe=None, dedupe_tolerance=0.05,
+        analysis_rate=None, incremental=False, identify_queue=None,
+        identified_callback=None, max_song_length=None, split_window=30,
+        level_rate=None, level_callback=None):
+
+        CaptureManager.__init__(self, output_directory, threshold, encoder,
+            apikey, song_callback, stop_callback, error_callback,
+            max_silence_length, min_song_length, block_size,
+            capture_queue_size, queue_size, export_workers,
+            identify_workers, checkpoint_interval, dedupe,
+            dedupe_tolerance, analysis_rate, incremental, identify_queue,
+            identified_callback, max_song_length, split_window, level_rate,
+            level_callback)
+
+        self.source = self.add_source(source, checkpoint=checkpoint)
+
+    def stats(self):
+        """Returns the throughput and queue depth of each stage. The
+        throughput of capture is in frames per second, the rest in items
+        per second
+        """
+
+        stats = self.source.stats()
+        for stage in self._stages():
+            stats[stage.name] = stage.stats()
+
+        if(self.consumer):
+            stats['identify_queue'] = self.consumer.stats()
+
+        return stats
+
+    def levels(self):
+        return self.source.levels()
+
+
+########################################################################
+# Command line
+########################################################################
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Extract music from a wav stream or an audio file')
+    parser.add_argument('input', nargs='*', default=['-'],
+        help="audio files, or '-' for a wav stream from the standard input. "
+        "Several inputs are extracted at the same time")
+    parser.add_argument('-o', '--output', default='.',
+        help='output directory')
+    parser.add_argument('-f', '--format', default='wav',
+        choices=['wav', 'flac'], help='output format')
+    parser.add_argument('-l', '--compression-level', type=int, default=5,
+        help='flac compression level, from 0 (fastest) to 8 (smallest)')
+    parser.add_argument('-t', '--threshold', type=int, default=10,
+        help='samples under the threshold are considered silence')
+    parser.add_argument('-k', '--apikey',
+        help='AcoustID API key, to identify and rename the songs')
+    parser.add_argument('--export-workers', type=int, default=2)
+    parser.add_argument('--identify-workers', type=int, default=1)
+    parser.add_argument('--checkpoint', metavar='PATH',
+        help='save the progress to resume the run if it is interrupted, '
+        'with several inputs in PATH.N for the Nth input')
+    parser.add_argument('--checkpoint-interval', type=float, default=30,
+        help='seconds between checkpoints')
+    parser.add_argument('--max-song-length', type=float, metavar='SECONDS',
+        help='split the songs longer than this at their quietest moment, '
+        'e.g. for continuous mixes')
+    parser.add_argument('--split-window', type=float, default=30,
+        metavar='SECONDS', help='the split is searched in the last '
+        'seconds before --max-song-length')
+    parser.add_argument('--dedupe', choices=['remove', 'link'],
+        help='remove repeated songs or replace them with hard links')
+    parser.add_argument('--analysis-rate', type=int, metavar='HZ',
+        help='frames per second analyzed to detect silences, e.g. 11025 '
+        'to speed up high resolution sources. The songs keep every frame')
+    parser.add_argument('--identify-queue', metavar='PATH',
+        help='queue the songs in this database to identify them in the '
+        'background. It can be shared with other runs and consumed by '
+        'IdentifyQueue.py')
+    parser.add_argument('--incremental', action='store_true',
+        help='write the songs while they are captured instead of when '
+        'they end. It can not be used with --checkpoint')
+    parser.add_argument('--stats', action='store_true',
+        help='print the stats of each stage at the end')
+    parser.add_argument('--metrics-log', action='store_true',
+        help='log the metrics periodically')
+    parser.add_argument('--metrics-file', metavar='PATH',
+        help='write the metrics periodically in the Prometheus text format')
+    parser.add_argument('--metrics-interval', type=float, default=10,
+        help='seconds between metric reports')
+    args = parser.parse_args(args)
+
+    sinks = []
+    if(args.metrics_log):
+        logging.basicConfig(level=logging.INFO)
+        sinks.append(Metrics.LogSink())
+    if(args.metrics_file):
+        sinks.append(Metrics.PrometheusSink(args.metrics_file))
+    if(sinks):
+        Metrics.start(sinks, args.metrics_interval)
+
+    def on_song(song):
+        if(song.duplicate_of):
+            print(u'{} is a copy of {}'.format(song.path, song.duplicate_of))
+        else:
+            print(u'{} ({} KB)'.format(song.path, song.size // 1024))
+
+    def on_identified(song):
+        print(u'{} identified'.format(song.path))
+
+    def on_error(stage, item, exception):
+        sys.stderr.write('{} failed: {}\n'.format(stage, exception))
+
+    pipeline = CaptureManager(args.output, threshold=args.threshold,
+        encoder=make_encoder(args.format, args.compression_level),
+        apikey=args.apikey, song_callback=on_song, error_callback=on_error,
+        export_workers=args.export_workers,
+        identify_workers=args.identify_workers,
+        checkpoint_interval=args.checkpoint_interval, dedupe=args.dedupe,
+        analysis_rate=args.analysis_rate, incremental=args.incremental,
+        identify_queue=args.identify_queue, identified_callback=on_identified,
+        max_song_length=args.max_song_length, split_window=args.split_window)
+
+    for i, source in enumerate(args.input):
+        checkpoint = args.checkpoint
+        if(checkpoint and len(args.input) > 1):
+            checkpoint = '{}.{}'.format(checkpoint, i)
+        pipeline.add_source(source, checkpoint=checkpoint)
+
+    pipeline.start()
+
+    for source in pipeline.sources:
+        if(source.resumed):
+            sys.stderr.write(u'Resuming {} from {}\n'.format(source.source,
+                source.checkpoint_path))
+
+    try:
+        #join with timeouts so Ctrl+C is not blocked
+        while(not pipeline.join(1)):
+            pass
+    except KeyboardInterrupt:
+        pipeline.stop()
+        pipeline.join()
+
+    Metrics.stop()
+
+    if(args.stats):
+        stats = pipeline.stats()
+        for source, source_stats in stats.pop('sources').items():
+            for name, stage_stats in source_stats.items():
+                sys.stderr.write('{} {}: {}\n'.format(source, name, stage_stats))
+        for name, stage_stats in stats.items():
+            sys.stderr.write('{}: {}\n'.format(name, stage_stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,15 +8,17 @@
 #standard library
 import os
 import sys
-import thread
+import math
 import time
+import threading
 
 #third party
-import acoustid
 import wx
 
 #local application
-from Raudio import FromFile, FromSystem, chunklist_to_file
+from Raudio import SystemInput, is_wav
+from Encoder import make_encoder
+from Pipeline import Pipeline
 
 
 ########################################################################
@@ -29,6 +31,20 @@ CHANNELS = 2                #stereo
 SAMPLE_WIDTH = 2            #bytes
 MIN_SONG_LENGTH = 1         #1 second. Sounds of shorter length will be discarded
 MAX_SILENCE_LENGTH = 0.2    #0.2 seconds. The max time of silence tolerated within a song
+MAX_SONG_LENGTH = 1800      #30 minutes. Longer sounds, e.g. continuous mixes, are split at their quietest moment. None for no limit
+OUTPUT_FORMAT = 'wav'       #'wav' or 'flac'. flac requires the flac command-line tool
+COMPRESSION_LEVEL = 5       #flac compression level, from 0 (fastest) to 8 (smallest)
+EXPORT_WORKERS = 2          #songs encoded at the same time
+IDENTIFY_WORKERS = 1        #songs identified at the same time
+CAPTURE_BUFFER_LENGTH = 30  #30 seconds. Audio that the capture can hold while the analysis falls behind
+CHECKPOINT_INTERVAL = 30    #30 seconds. Files are resumed from the last checkpoint if the extraction is interrupted
+ANALYSIS_RATE = None        #frames per second analyzed to detect silences, None for all. Lower values speed up high resolution files
+STOP_TIMEOUT = 10           #10 seconds. Max time waiting for the workers on close
+DEDUPE = None               #'remove', 'link' (hard links to the first copy) or None to keep repeated songs
+INCREMENTAL_EXPORT = True   #write the recorded songs while they are captured instead of when they end
+LEVEL_RATE = 20             #levels per second published by the segmentation for the meter
+METER_FPS = 10              #max redraws per second of the meter
+IDENTIFY_QUEUE = '.queue.db' #songs waiting to be identified, kept in the output directory across runs. None identifies them right after the export
 
 
 def resource_path(relative_path):
@@ -42,6 +58,93 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+class LevelPanel(wx.Panel):
+    """Level meter and scrolling overview of the last levels (see 
+    LevelMeter), the newest on the right. The levels are drawn in dB 
+    from FLOOR_DB to 0, so the threshold is visible. The clip mark 
+    stays red once the audio reached full scale
+    """
+
+    FLOOR_DB = -90.0
+    METER_HEIGHT = 12
+    CLIP_WIDTH = 8
+
+    def __init__(self, parent, threshold=0.0):
+        wx.Panel.__init__(self, parent, size=(-1, 70), 
+            style=wx.FULL_REPAINT_ON_RESIZE)
+        self.SetBackgroundStyle(wx.BG_STYLE_CUSTOM)
+        self.SetMinSize((-1, 70))
+        self.threshold = threshold
+        self.levels = None
+        self.Bind(wx.EVT_PAINT, self.on_paint)
+
+
+    def set_levels(self, levels):
+        self.levels = levels
+        self.Refresh(False)
+
+
+    def scale(self, level, length):
+        """Position of level, a fraction of the full scale, in a bar of 
+        length pixels
+        """
+        if(level <= 0):
+            return 0
+        db = 20 * math.log10(level)
+        return int(max(0.0, min(1.0, 1 - db / self.FLOOR_DB)) * length)
+
+
+    def on_paint(self, event):
+        dc = wx.BufferedPaintDC(self)
+        dc.SetBackground(wx.Brush(wx.Colour(30, 30, 30)))
+        dc.Clear()
+
+        width, height = self.GetClientSize()
+        meter_width = width - self.CLIP_WIDTH - 2
+        top = self.METER_HEIGHT + 2
+        overview = height - top
+        levels = self.levels
+
+        if(levels):
+            #meter
+            dc.SetPen(wx.TRANSPARENT_PEN)
+            dc.SetBrush(wx.Brush(wx.Colour(60, 180, 75)))
+            dc.DrawRectangle(0, 0, self.scale(levels.rms, meter_width), 
+                self.METER_HEIGHT)
+
+            x = self.scale(levels.peak, meter_width)
+            dc.SetPen(wx.Pen(wx.Colour(240, 200, 40), 2))
+            dc.DrawLine(x, 0, x, self.METER_HEIGHT)
+
+            #overview, one level per pixel
+            history = levels.history[-width:]
+            offset = width - len(history)
+            bottom = height - 1
+            dc.DrawLineList([(offset + i, bottom, offset + i, 
+                bottom - self.scale(p, overview)) 
+                for i, (p, r) in enumerate(history)], 
+                wx.Pen(wx.Colour(40, 110, 50)))
+            dc.DrawLineList([(offset + i, bottom, offset + i, 
+                bottom - self.scale(r, overview)) 
+                for i, (p, r) in enumerate(history)], 
+                wx.Pen(wx.Colour(60, 180, 75)))
+
+        #clip mark
+        clipped = levels is not None and levels.clips > 0
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush(wx.Colour(220, 40, 40) if(clipped) else wx.Colour(70, 70, 70)))
+        dc.DrawRectangle(width - self.CLIP_WIDTH, 0, self.CLIP_WIDTH, 
+            self.METER_HEIGHT)
+
+        #threshold
+        dc.SetPen(wx.Pen(wx.Colour(200, 200, 200), 1, wx.PENSTYLE_DOT 
+            if(hasattr(wx, 'PENSTYLE_DOT')) else wx.DOT))
+        x = self.scale(self.threshold, meter_width)
+        dc.DrawLine(x, 0, x, self.METER_HEIGHT)
+        y = height - 1 - self.scale(self.threshold, overview)
+        dc.DrawLine(0, y, width, y)
+
+
 class RaudianFrame(wx.Frame):
 
     ####################################################################
@@ -55,7 +158,10 @@ class RaudianFrame(wx.Frame):
     # INIT
     ####################################################################
     def __init__(self, title):
-        wx.Frame.__init__(self, None, title=title, size=(350,300))
+        wx.Frame.__init__(self, None, title=title, size=(350,380))
+        self.pipeline = None
+        self._levels_pending = False
+        self._levels_drawn = 0
         self.init_gui()
 
 
@@ -80,7 +186,8 @@ class RaudianFrame(wx.Frame):
 
         #source file
         self.source_file_picker =  wx.FilePickerCtrl(self, wx.ID_ANY,
-            message='Please select the wav file', wildcard='*.wav', 
+            message='Please select the audio file', 
+            wildcard='Audio files|*.wav;*.flac;*.mp3;*.ogg;*.m4a|All files|*.*', 
             size=(500, 30))
         self.source_file_picker.Disable()
         main_sizer.Add(self.source_file_picker, 0, wx.ALL, 5)
@@ -112,6 +219,11 @@ class RaudianFrame(wx.Frame):
         main_sizer.Add(self.message_box, 0, wx.ALL|wx.EXPAND, 5)
         self.message_box.SetLabel('Hi!')
 
+        #levels
+        full_scale = float(2 ** (8 * SAMPLE_WIDTH - 1))
+        self.level_panel = LevelPanel(self, threshold=THRESHOLD[0] / full_scale)
+        main_sizer.Add(self.level_panel, 0, wx.ALL|wx.EXPAND, 5)
+
 
         #init frame
         icon = wx.IconFromBitmap(wx.Bitmap(resource_path("icon.ico"), wx.BITMAP_TYPE_ANY))
@@ -135,9 +247,10 @@ class RaudianFrame(wx.Frame):
                 self.disable_controls()
                 self.set_stop_button()
         else:
+            #on_finish enables the button and the controls once it stops
             if(self.stop()):
-                self.enable_controls()
-                self.set_start_button()
+                self.print_message('Stopping...')
+                return
 
         self.button.Enable()
 
@@ -149,36 +262,61 @@ class RaudianFrame(wx.Frame):
             self.source_file_picker.Enable()
 
 
-    def on_update(self, chunk, progress=None):
+    def on_song(self, song):
+        if(song.duplicate_of):
+            wx.CallAfter(self.print_message, u'Repeated Song: {}'.format(
+                os.path.basename(song.duplicate_of)))
+            return
+
+        wx.CallAfter(self.print_message, u'New Song: {} ({} KB)'.format(
+            os.path.basename(song.path), song.size // 1024))
+
 
-        #if found a music
-        #Chunk under threshold and size less than 0.2s (because the song 
-        #ends with silence but may have short moments of silence),
-        #Check that chunks are not empty(to dismiss the initial silence)
-        if(chunk.under and chunk.size > FRAME_RATE * MAX_SILENCE_LENGTH and self.chunks):
+    def on_levels(self, name, levels):
+        #called from the segmentation for each level. The redraws are 
+        #capped at METER_FPS and only one is queued at a time, so a slow 
+        #GUI never holds back the segmentation
+        now = time.time()
+        if(self._levels_pending or now - self._levels_drawn < 1.0 / METER_FPS):
+            return
 
-            #save song if it is greater than a second
-            if(sum([c.size for c in self.chunks]) > FRAME_RATE * MIN_SONG_LENGTH):
-                thread.start_new_thread(self.save, (list(self.chunks), ))
+        self._levels_pending = True
+        self._levels_drawn = now
+        wx.CallAfter(self.draw_levels)
 
-            #reset chunks
-            self.chunks = []
 
-        else:
-            self.chunks.append(chunk)
+    def on_identified(self, song):
+        wx.CallAfter(self.print_message, u'Identified: {}'.format(
+            os.path.basename(song.path)))
+
+
+    def on_error(self, stage, item, exception):
+        if(stage == 'export'):
+            wx.CallAfter(self.print_message, u'Can not save the song')
+
+
+    def on_finish(self):
+        wx.CallAfter(self.set_start_button)
+        wx.CallAfter(self.enable_controls)
+        wx.CallAfter(self.button.Enable)
+
+
+    def on_stopped(self, stopped):
+        if(not stopped):
+            self.print_message('The extraction is taking long to stop...')
 
 
     def on_close(self, event):
-        self.stop()
-        sys.exit(0)
+        #pending songs are exported before exit
+        self.Hide()
+        if(not self.stop(callback=lambda stopped: self.Destroy())):
+            self.Destroy()
 
 
     ####################################################################
     # UTILS
     ####################################################################
     def start(self):
-        
-        self.chunks = []
 
         #check that the output directory is selected
         if(not self.get_output_directory()):
@@ -191,12 +329,32 @@ class RaudianFrame(wx.Frame):
             return self.extract_from_file()
 
 
-    def stop(self):
+    def stop(self, callback=None):
+        """Stops the pipeline and waits for it in another thread, so the 
+        window keeps responding. callback receives from the wx thread 
+        whether it stopped within STOP_TIMEOUT, on_stopped by default
+        """
+
         try:
-            self.raudio.stop()
+            self.pipeline.stop()
         except:
             return False
 
+        pipeline = self.pipeline
+        callback = callback or self.on_stopped
+
+        def wait():
+            try:
+                stopped = pipeline.join(STOP_TIMEOUT)
+            except Exception:
+                #a stage failed, but it stopped
+                stopped = True
+            wx.CallAfter(callback, stopped)
+
+        thread = threading.Thread(target=wait)
+        thread.daemon = True
+        thread.start()
+
         return True
 
 
@@ -204,10 +362,12 @@ class RaudianFrame(wx.Frame):
         
         #start extraction
         try:
-            self.raudio = FromSystem(channels=CHANNELS, 
+            source = SystemInput(channels=CHANNELS, 
                 sample_width=SAMPLE_WIDTH, frame_rate=FRAME_RATE, 
-                threshold=THRESHOLD, update_callback=self.on_update)
-            self.raudio.start()
+                buffer_length=CAPTURE_BUFFER_LENGTH)
+            self.pipeline = self.make_pipeline(source, 
+                stop_callback=self.on_finish)
+            self.pipeline.start()
             self.print_message('Recording...')
         except:
             return False
@@ -217,49 +377,53 @@ class RaudianFrame(wx.Frame):
 
     def extract_from_file(self):
 
-        #check that the wav file is selected
+        #check that the source file is selected
         if(not self.get_source_file()):
-            self.alert('Select wav source file', 'Error')
+            self.alert('Select the source file', 'Error')
             return False
 
         #start extraction
         try:
-            self.raudio = FromFile(self.get_source_file(), 
-                threshold=(10, 10), update_callback=self.on_update, 
-                stop_callback=self.set_start_button)
-            self.raudio.start()
-            self.print_message('Processing...')
+            source = self.get_source_file()
+            #decoded files can not be resumed, their chunks are temporary
+            checkpoint = None
+            if(is_wav(source)):
+                checkpoint = os.path.join(self.get_output_directory(), 
+                    u'.{}.checkpoint'.format(os.path.basename(source)))
+            self.pipeline = self.make_pipeline(source, 
+                stop_callback=self.on_finish, checkpoint=checkpoint)
+            self.pipeline.start()
+            if(self.pipeline.source.resumed):
+                self.print_message('Resuming the last extraction...')
+            else:
+                self.print_message('Processing...')
         except:
             return False
             
         return True
 
 
-    def save(self, chunks):
-
-        #save song
-        try:
-            #get output path
-            directory = self.get_output_directory()
-            filename = 'unknown_{}.wav'.format(time.time())
-            path = os.path.join(directory, filename)
-
-            #save as wav file
-            chunklist_to_file(path, chunks)
-        except:
-            wx.CallAfter(self.print_message, u'Can not save {}'.format(path))
-            return
-
-        #try to identify and rename song
-        try:
-            score, rid, title, artist = acoustid.match(ACOUSTID_API_KEY, path).next()
-            filename = u'{0} - {1}.wav'.format(artist, title).replace('/', '')
-            new_path = os.path.join(directory, filename)
-            os.rename(path, new_path)
-        except:
-            pass
-        
-        wx.CallAfter(self.print_message, u'New Song: {}'.format(filename))
+    def make_pipeline(self, source, stop_callback=None, checkpoint=None):
+        identify_queue = None
+        if(IDENTIFY_QUEUE):
+            identify_queue = os.path.join(self.get_output_directory(), 
+                IDENTIFY_QUEUE)
+
+        return Pipeline(source, self.get_output_directory(), 
+            threshold=THRESHOLD, 
+            encoder=make_encoder(OUTPUT_FORMAT, COMPRESSION_LEVEL), 
+            apikey=ACOUSTID_API_KEY, song_callback=self.on_song, 
+            stop_callback=stop_callback, error_callback=self.on_error, 
+            max_silence_length=MAX_SILENCE_LENGTH, 
+            min_song_length=MIN_SONG_LENGTH, export_workers=EXPORT_WORKERS,
+            identify_workers=IDENTIFY_WORKERS, checkpoint=checkpoint, 
+            checkpoint_interval=CHECKPOINT_INTERVAL, dedupe=DEDUPE, 
+            analysis_rate=ANALYSIS_RATE, 
+            incremental=INCREMENTAL_EXPORT and checkpoint is None, 
+            identify_queue=identify_queue, 
+            identified_callback=self.on_identified, 
+            max_song_length=MAX_SONG_LENGTH, level_rate=LEVEL_RATE, 
+            level_callback=self.on_levels)
 
 
     def get_source_type(self):
@@ -278,6 +442,15 @@ class RaudianFrame(wx.Frame):
     def print_message(self, message):
         self.message_box.SetLabel(message)
 
+    def draw_levels(self):
+        self._levels_pending = False
+
+        #the last levels, not the ones that requested the redraw
+        if(self.pipeline):
+            levels = self.pipeline.levels()
+            if(levels):
+                self.level_panel.set_levels(levels)
+
 
     def alert(self, message, caption):
         alert = wx.MessageDialog(self, message, caption, wx.OK | wx.ICON_WARNING)
@@ -1,17 +1,40 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import sys
 import wave
+import time
+import array
 import struct
 import tempfile
+import threading
 
 from collections import namedtuple
 from Worker import Worker
+from Samples import energy, peak
+import Metrics
 
 try:
     import pyaudio
 except:
     pass
 
+try:
+    import audioread
+    have_audioread = True
+except ImportError:
+    have_audioread = False
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
 
 ########################################################################
 # Exceptions
@@ -27,23 +50,13 @@ class SampleWidthException(BaseException):
 ########################################################################
 # Utilities
 ########################################################################
-def chunklist_to_file(output_path, chunklist, cache_size=1024):
-    """Exports all chunks to a wav file
+def iter_chunklist(chunklist, cache_size=1024):
+    """Generates the frames of all chunks in blocks of at most cache_size
+    frames
     """
 
-    #output wav
-    output = wave.open(output_path, 'w')
-    first = True
-
     for c in chunklist:
 
-        #get audio params from first chunk
-        if(first):                
-            output.setnchannels(c.channels)
-            output.setsampwidth(c.sample_width)
-            output.setframerate(c.frame_rate)
-            first = False
-
         #wav corresponding to the current chunk
         audio = wave.open(c.path, 'r')
 
@@ -51,26 +64,588 @@ def chunklist_to_file(output_path, chunklist, cache_size=1024):
         end = c.offset + c.size
 
         #Reads the frames from the file corresponding to the current 
-        #chunk and write them in the output file
+        #chunk
         for o in range(c.offset, end, cache_size):
             cs = cache_size if o + cache_size <= end else end - o
             audio.setpos(o)
-            output.writeframes(audio.readframes(cs))
+            yield audio.readframes(cs)
 
         audio.close()
 
-    output.close()
+
+def chunklist_to_file(output_path, chunklist, cache_size=1024, tap=None):
+    """Exports all chunks to a wav file. If tap is given, it receives 
+    each block of frames written, e.g. to analyze the song while it's 
+    exported
+    """
+
+    #output wav
+    output = wave.open(output_path, 'w')
+
+    #get audio params from first chunk
+    output.setnchannels(chunklist[0].channels)
+    output.setsampwidth(chunklist[0].sample_width)
+    output.setframerate(chunklist[0].frame_rate)
+
+    with Metrics.timer('export'):
+        for data in iter_chunklist(chunklist, cache_size):
+            output.writeframes(data)
+            Metrics.count('export_bytes', len(data))
+            if(tap):
+                tap(data)
+
+        output.close()
+
+
+def quietest_frame(data, sample_width, channels, frame_rate, resolution=0.05):
+    """Returns the frame in the middle of the quietest window of 
+    resolution seconds of data, the last one if there are several, e.g.
+    to split a song that never goes silent
+    """
+
+    frame_size = sample_width * channels
+    window = max(int(frame_rate * resolution), 1) * frame_size
+    best = None
+
+    for o in range(0, len(data) - len(data) % frame_size, window):
+        total, samples = energy(data[o:o + window], sample_width)
+        level = total / float(samples)
+        if(best is None or level <= best[0]):
+            best = (level, o + min(window, len(data) - o) // 2)
+
+    if(best is None):
+        return 0
+    return best[1] // frame_size
+
+
+def split_chunks(chunks, frames):
+    """Splits a list of chunks at frames frames from its start. Returns 
+    the chunks before and after that frame
+    """
+
+    for i, c in enumerate(chunks):
+        if(frames < c.size):
+            head, tail = chunks[:i], chunks[i + 1:]
+            if(frames):
+                head.append(c._replace(size=frames))
+            return head, [c._replace(offset=c.offset + frames, 
+                size=c.size - frames)] + tail
+        frames -= c.size
+
+    return list(chunks), []
+
+
+def open_input(source):
+    """Opens an input for the streaming segmentation. source can be '-' 
+    for the standard input, a file object with a wav stream or the path 
+    of any file that audioread can decode. Returns the reader and, if 
+    the frames can be read again from the source, its path
+    """
+
+    if(source == '-'):
+        #python 3 reads bytes from the buffer of the text stream
+        source = getattr(sys.stdin, 'buffer', sys.stdin)
+
+        #avoid the newline translation on windows
+        if(sys.platform == 'win32'):
+            import msvcrt
+            msvcrt.setmode(source.fileno(), os.O_BINARY)
+
+    if(not isinstance(source, basestring)):
+        return wave.open(source, 'rb'), None
+
+    #wav files are read directly, other formats are decoded on the fly
+    try:
+        return wave.open(source, 'rb'), source
+    except (wave.Error, EOFError):
+        if(not have_audioread):
+            raise
+        return DecodedAudio(source), None
+
+
+def is_wav(path):
+    """True if path is a wav file, which is read directly and can be read 
+    again, instead of being decoded
+    """
+
+    try:
+        wave.open(path, 'rb').close()
+    except (wave.Error, EOFError, IOError):
+        return False
+    return True
+
+
+def _get_format(sample_width):
+    """converts sample_width from the wave format to pyaudio format
+    """
+
+    if(sample_width == 1):
+        return pyaudio.paInt8
+    elif(sample_width == 2):
+        return pyaudio.paInt16
+    elif(sample_width == 3):
+        return pyaudio.paInt24
+    elif(sample_width == 4):
+        return pyaudio.paInt32
+        
+    raise SampleWidthException('Invalid sample width')
 
 
 ########################################################################
 # Classes
 ########################################################################
 Chunk = namedtuple('Chunk', 'offset size under over path channels sample_width frame_rate')
+Levels = namedtuple('Levels', 'peak rms clips history')
+
+
+class SpillBuffer(object):
+    """Append-only storage for audio read from sources that can not be 
+    read twice, like pipes or sockets. The frames are written to 
+    temporary wav segments so chunks can reference them by path and 
+    offset, just like the chunks of FromFile reference the input file.
+    A new segment is started when the current one exceeds segment_size
+    frames, but only between runs, so a chunk never spans two segments.
+    The segments are kept until discard deletes them
+    """
+
+    def __init__(self, channels, sample_width, frame_rate, segment_size=None):
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+
+        #one minute per segment by default
+        self.segment_size = segment_size or frame_rate * 60
+
+        self.path = None
+        self.segments = []
+        self._file = None
+        self._audio = None
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """Starts a new run and returns the path and offset where its 
+        first frame will be written
+        """
+
+        if(self._audio is None or self._audio.tell() >= self.segment_size):
+            self._open_segment()
+
+        return self.path, self._audio.tell()
+
+    def write(self, data):
+        """Appends frames to the current segment. The wave module 
+        patches the header after each write, so flushing is enough to 
+        make the frames readable by chunklist_to_file
+        """
+
+        self._audio.writeframes(data)
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if(self._audio is not None):
+                self._audio.close()
+                self._file.close()
+                self._audio = None
+                self._file = None
+
+    def discard(self, keep):
+        """Deletes the segments older than the oldest one in keep, the 
+        paths that chunks still reference. The segment being written is
+        never deleted. Can be called from any thread
+        """
+
+        with self._lock:
+            while(self.segments):
+                path = self.segments[0]
+                if(path in keep or (path == self.path and self._audio is not None)):
+                    break
+
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                del self.segments[0]
+                Metrics.count('spill_segments_discarded')
+
+    def remove(self):
+        """Closes the buffer and deletes every segment
+        """
+
+        self.close()
+        self.discard(())
+
+    def _open_segment(self):
+        self.close()
+
+        with self._lock:
+            self._file = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
+            self.path = self._file.name
+            self.segments.append(self.path)
+            self._audio = wave.open(self._file, 'wb')
+            self._audio.setnchannels(self.channels)
+            self._audio.setsampwidth(self.sample_width)
+            self._audio.setframerate(self.frame_rate)
+
+
+class DirectReference(object):
+    """Takes the place of the spill buffer when the frames come from a 
+    wav file that can be read again. Nothing is copied, the chunks 
+    reference the input file
+    """
+
+    def __init__(self, path, channels, sample_width, frame_rate, position=0):
+        self.path = path
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self._position = position
+        self._frame_size = channels * sample_width
+
+    def begin(self):
+        return self.path, self._position
+
+    def write(self, data):
+        self._position += len(data) // self._frame_size
+
+    def close(self):
+        pass
+
+
+class DecodedAudio(object):
+    """Reads any format that audioread can decode (flac, mp3, ogg...) 
+    through the same methods used from wave readers, so the streaming
+    segmentation can run directly on the decoded PCM blocks. audioread
+    always delivers 16-bit samples
+    """
+
+    def __init__(self, path):
+        self._file = audioread.audio_open(path)
+        self._blocks = iter(self._file)
+        self._buffer = b''
+        self._frame_size = self._file.channels * 2
+        self._position = 0
+
+    def getnchannels(self):
+        return self._file.channels
+
+    def getsampwidth(self):
+        return 2
+
+    def getframerate(self):
+        return self._file.samplerate
+
+    def getnframes(self):
+        """It's an estimation based on the duration reported by the 
+        decoder
+        """
+        return int(self._file.duration * self._file.samplerate)
+
+    def tell(self):
+        return self._position
+
+    def setpos(self, pos):
+        """Decoders can not seek, so it only moves forward by decoding and
+        discarding the frames
+        """
+
+        if(pos < self._position):
+            raise ValueError('DecodedAudio can not move backwards')
+
+        while(self._position < pos):
+            if(not self.readframes(min(pos - self._position, 65536))):
+                break
+
+    def readframes(self, nframes):
+        size = nframes * self._frame_size
+
+        #join decoded blocks until the requested frames are available
+        blocks = [self._buffer]
+        available = len(self._buffer)
+        while(available < size):
+            try:
+                block = next(self._blocks)
+            except StopIteration:
+                break
+            blocks.append(block)
+            available += len(block)
+
+        data = b''.join(blocks)
+        self._buffer = data[size:]
+        data = data[:size]
+
+        self._position += len(data) // self._frame_size
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class RingBuffer(object):
+    """Preallocated circular buffer between a producer that must never 
+    wait, like the PyAudio stream callback, and a consumer that reads it 
+    through readframes like a wave file. If the consumer falls behind 
+    and the buffer gets full, the buffer grows instead of dropping 
+    samples. overruns counts how many times it happened
+    """
+
+    def __init__(self, frame_size, capacity):
+        self.frame_size = frame_size
+        self.overruns = 0
+        self._data = bytearray(capacity * frame_size)
+        self._start = 0
+        self._size = 0
+        self._closed = False
+        self._state = threading.Condition()
+
+    def __len__(self):
+        """Frames waiting to be read
+        """
+        return self._size // self.frame_size
+
+    def write(self, data):
+
+        with self._state:
+
+            if(self._size + len(data) > len(self._data)):
+                self._grow(self._size + len(data))
+
+            #copy after the last byte, wrapping around the end
+            capacity = len(self._data)
+            end = (self._start + self._size) % capacity
+            first = min(len(data), capacity - end)
+            self._data[end:end + first] = data[:first]
+            self._data[:len(data) - first] = data[first:]
+            self._size += len(data)
+
+            self._state.notify()
+
+    def readframes(self, nframes):
+        """Waits until there is at least one frame and returns up to 
+        nframes. Returns an empty string once the buffer is closed and 
+        there are no more frames
+        """
+
+        with self._state:
+
+            while(not self._size and not self._closed):
+                self._state.wait()
+
+            size = min(nframes * self.frame_size, self._size)
+            size -= size % self.frame_size
+
+            capacity = len(self._data)
+            first = min(size, capacity - self._start)
+            data = bytes(self._data[self._start:self._start + first] + 
+                self._data[:size - first])
+
+            self._start = (self._start + size) % capacity
+            self._size -= size
+
+            return data
+
+    def close(self):
+        """No more frames will be written. Wakes up the reader
+        """
+        with self._state:
+            self._closed = True
+            self._state.notify_all()
+
+    def _grow(self, size):
+        self.overruns += 1
+        Metrics.count('ring_overruns')
+
+        #linearize the content in a buffer twice as big
+        capacity = len(self._data)
+        first = min(self._size, capacity - self._start)
+        data = bytearray(max(capacity * 2, size))
+        data[:first] = self._data[self._start:self._start + first]
+        data[first:self._size] = self._data[:self._size - first]
+
+        self._data = data
+        self._start = 0
+
+
+class LevelMeter(object):
+    """Decimated envelope of the audio read by the segmentation: the 
+    peak and the RMS of every 1 / rate seconds, as fractions of the full
+    scale. add receives the blocks already read for the analysis, so 
+    it only adds a couple of C loops per block. Each point replaces 
+    snapshot with a new immutable Levels, with the last point, the 
+    points that reached full scale (clips) and the history of the last 
+    length seconds, so other threads read it without locks. callback 
+    receives each snapshot, from the segmentation thread
+    """
+
+    def __init__(self, rate=20, length=60, callback=None):
+        self.rate = rate
+        self.length = length
+        self.callback = callback
+        self.snapshot = Levels(0.0, 0.0, 0, ())
+
+    def start(self, channels, sample_width, frame_rate):
+        self.sample_width = sample_width
+        self._frame_size = channels * sample_width
+        self._interval = max(frame_rate // self.rate, 1)
+        self._full_scale = float(2 ** (8 * sample_width - 1))
+        self._history = []
+        self._clips = 0
+        self._reset()
+
+    def add(self, data):
+        frame_size = self._frame_size
+        o = 0
+
+        while(o < len(data)):
+            size = min((self._interval - self._frames) * frame_size, len(data) - o)
+            block = data[o:o + size]
+            o += size
+
+            total, samples = energy(block, self.sample_width)
+            self._peak = max(self._peak, peak(block, self.sample_width))
+            self._energy += total
+            self._samples += samples
+            self._frames += size // frame_size
+
+            if(self._frames >= self._interval):
+                self._publish()
+
+    def _publish(self):
+        level_peak = min(self._peak / self._full_scale, 1.0)
+        rms = (self._energy / float(max(self._samples, 1))) ** 0.5 / self._full_scale
+        self._reset()
+
+        if(level_peak >= 1.0 - 1.0 / self._full_scale):
+            self._clips += 1
+
+        self._history.append((level_peak, rms))
+        del self._history[:-self.rate * self.length]
+
+        #rebinding the attribute is atomic, readers get the old or the new one
+        self.snapshot = Levels(level_peak, rms, self._clips, tuple(self._history))
+
+        if(callable(self.callback)):
+            self.callback(self.snapshot)
+
+    def _reset(self):
+        self._peak = 0
+        self._energy = 0
+        self._samples = 0
+        self._frames = 0
+
+
+class SystemInput(object):
+    """Reads the system input through PyAudio stream callbacks. The 
+    callback runs on the PortAudio thread and only copies each block into
+    a RingBuffer of buffer_length seconds, which is read through 
+    readframes like a wave file. device is the index of the PyAudio input
+    device, by default the system default one. The stream is opened by 
+    the first readframes, so an input that is never read, e.g. because 
+    the pipeline failed to start, does not keep the device open
+    """
+
+    def __init__(self, channels=1, sample_width=2, frame_rate=44100, 
+        buffer_length=30, device=None):
+
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self.device = device
+        self.input_overflows = 0
+
+        self.ring = RingBuffer(channels * sample_width, 
+            int(frame_rate * buffer_length))
+
+        self.pyaudio = None
+        self.stream = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sample_width
+
+    def getframerate(self):
+        return self.frame_rate
+
+    def readframes(self, nframes):
+        if(self.stream is None):
+            self._open()
+        return self.ring.readframes(nframes)
+
+    @property
+    def overruns(self):
+        return self.ring.overruns
+
+    def interrupt(self):
+        """Wakes up the reader. readframes returns the remaining frames 
+        and then an empty string
+        """
+        self.ring.close()
+
+    def close(self):
+        self.ring.close()
+
+        with self._lock:
+            self._closed = True
+            if(self.stream):
+                self.stream.close()
+            if(self.pyaudio):
+                self.pyaudio.terminate()
+            self.stream = self.pyaudio = None
+
+    def _open(self):
+        with self._lock:
+            #a closed input only returns what is left in the ring
+            if(self._closed or self.stream):
+                return
+
+            self.pyaudio = pyaudio.PyAudio()
+            try:
+                self.stream = self.pyaudio.open(
+                    format = _get_format(self.sample_width),
+                    channels = self.channels,
+                    rate = self.frame_rate,
+                    input = True,
+                    input_device_index = self.device,
+                    frames_per_buffer = 1024,
+                    stream_callback = self._on_audio
+                )
+            except Exception:
+                self.pyaudio.terminate()
+                self.pyaudio = None
+                raise
+
+    def _on_audio(self, data, frame_count, time_info, status):
+        """PyAudio stream callback. It only copies the block
+        """
+
+        if(status & pyaudio.paInputOverflow):
+            self.input_overflows += 1
+            Metrics.count('input_overflows')
+
+        self.ring.write(data)
+        return (None, pyaudio.paContinue)
+
 
 class AudioWorker(Worker):
     
     def __init__(self):
         Worker.__init__(self)
+        self.writer = None
+        self.meter = None
+
+    def discard_spill(self, keep):
+        """Deletes the spill segments older than the oldest path in keep,
+        the ones that chunks not exported yet still reference (see 
+        SpillBuffer.discard). Does nothing if the chunks reference the 
+        input. Can be called from any thread
+        """
+        spill = getattr(self, 'spill', None)
+        if(hasattr(spill, 'discard')):
+            spill.discard(keep)
 
     def _make_unpack(self, sample_width, channels):
         """Build and returns the unpack function according to the sample 
@@ -87,11 +662,12 @@ class AudioWorker(Worker):
         elif(sample_width == 3):
             """The struct module has no option to read 3-byte integers, so 
             it is read as 4-byte integers, but it is necessary to add the 
-            fourth byte
+            fourth byte. It's added as the lowest byte, so negative samples
+            keep their sign, and removed with the shift
             """
             fmt = '<{}l'.format(channels)
-            return lambda frame: struct.unpack(fmt, ''.join(
-                [frame[i:i+3] + b'\x00' for i in range(0, len(frame), 3)]))
+            return lambda frame: [v >> 8 for v in struct.unpack(fmt, b''.join(
+                [b'\x00' + frame[i:i+3] for i in range(0, len(frame), 3)]))]
         elif(sample_width == 4):
             fmt = '<{}l'.format(channels)
             return lambda frame: struct.unpack(fmt, frame)
@@ -112,8 +688,8 @@ class AudioWorker(Worker):
 
         def compare(frame):
 
-            #If it's the last frame
-            if(frame == ''):
+            #If it's the last frame, b'' in python 3 is not equal to ''
+            if(not frame):
                 return None
             else:
                 #The samples from each channel must be less than the corresponding threshold
@@ -122,20 +698,575 @@ class AudioWorker(Worker):
         return compare    
 
 
+    def _make_block_test(self, sample_width, channels, threshold):
+        """Returns a function that takes a block of frames and returns 
+        True if all of them are under the threshold, like compare does 
+        with each frame. The samples are tested with the min and max of 
+        each channel, so the frames are not unpacked one by one. Returns
+        None if the sample width is not supported (3-byte samples need 
+        the audioop of python 3.4 or later)
+        """
+
+        if(sample_width == 3):
+            try:
+                audioop.lin2lin(b'', 3, 4)
+            except Exception:
+                return None
+
+            #as 4-byte samples, the threshold is scaled the same way
+            convert = lambda data: audioop.lin2lin(data, 3, 4)
+            threshold = [t << 8 for t in threshold]
+            sample_width = 4
+        else:
+            convert = lambda data: data
+
+        typecode = {1: 'b', 2: 'h', 4: 'i'}.get(sample_width)
+        if(typecode is None or array.array(typecode).itemsize != sample_width):
+            return None
+
+        def test(data):
+            samples = array.array(typecode, convert(data))
+            if(sys.byteorder == 'big'):
+                samples.byteswap()
+
+            for c in range(channels):
+                values = samples[c::channels]
+                if(max(values) > threshold[c] or min(values) < -threshold[c]):
+                    return False
+
+            return True
+
+        return test
+
+
+    def _start_coarse(self, channels, sample_width, frame_rate, 
+        max_silence_length, block_length):
+        """Prepares the coarse to fine scan (see FromFile) of _scan_blocks.
+        Returns False if the blocks of this sample width can not be tested
+        as a whole
+        """
+
+        self.block_test = self._make_block_test(sample_width, channels, 
+            self.threshold)
+        if(self.block_test is None):
+            return False
+
+        self.silence = int(frame_rate * max_silence_length)
+
+        """a silence longer than max_silence_length contains at least
+        silence // block - 1 whole blocks, so the blocks are small 
+        enough to fit a few in it
+        """
+        self.block = max(min(int(frame_rate * block_length), 
+            self.silence // 4), 1)
+        self.min_blocks = max(self.silence // self.block - 1, 1)
+
+        self._frame_size = channels * sample_width
+        self._start = 0         #first frame not delivered yet
+        self._run = None        #first frame of the run of silent blocks
+        self._run_blocks = 0
+        self._before = None     #the block before the run
+        self._last = None
+        return True
+
+    def _scan_blocks(self, position, data):
+        """Tests the blocks of data, which starts at frame position, as a 
+        whole. A run of silent blocks long enough ends at the first block 
+        with sound. Empty data means the end of the audio. The chunks are 
+        given to _coarse_chunk
+        """
+
+        if(not data):
+            if(self._run is not None and self._run_blocks >= self.min_blocks):
+                self._end_run(position)
+            if(position > self._start):
+                self._coarse_chunk(self._start, position - self._start, False)
+            return
+
+        size = self.block * self._frame_size
+        for o in range(0, len(data), size):
+            block = data[o:o + size]
+            frame = position + o // self._frame_size
+
+            if(self.block_test(block)):
+                if(self._run is None):
+                    self._run = frame
+                    self._run_blocks = 0
+                    self._before = self._last
+                self._run_blocks += 1
+
+            elif(self._run is not None):
+                if(self._run_blocks >= self.min_blocks):
+                    self._end_run(frame + self._count_silent(block))
+                self._run = None
+
+            self._last = block
+
+        Metrics.count('frames_scanned', len(data) // self._frame_size)
+
+    def _end_run(self, end):
+        """end is the exact end of the silence that contains the run. Its
+        start is searched backwards in the block before the run, but not
+        before the frames already delivered
+        """
+
+        start = self._run
+        if(self._before):
+            start -= self._count_silent(self._before, True)
+        start = max(start, self._start)
+
+        if(end - start > self.silence):
+            if(start > self._start):
+                self._coarse_chunk(self._start, start - self._start, False)
+            self._coarse_chunk(start, end - start, True)
+            self._start = end
+
+    def _count_silent(self, data, backwards=False):
+        """Number of frames under the threshold at the beginning or the 
+        end of data
+        """
+
+        frame_size = self._frame_size
+        offsets = range(0, len(data), frame_size)
+        if(backwards):
+            offsets = reversed(offsets)
+
+        count = 0
+        for o in offsets:
+            if(self.compare(data[o:o + frame_size]) != True):
+                break
+            count += 1
+
+        Metrics.count('frames_refined', count + 1)
+        return count
+
+    def _coarse_chunk(self, offset, size, under):
+        raise NotImplementedError("Please Implement this method")
+
+    def _start_stream(self, channels, sample_width, frame_rate, 
+        block_size=1024, path=None, offset=0, analysis_rate=None, 
+        writer=None, meter=None):
+        """Prepares the state used by _read_run. Frames are read in 
+        blocks of block_size frames and kept in a lookahead buffer, so the 
+        audio source does not need to support setpos. If path is given,
+        the frames are read from that wav file, starting at offset, and 
+        the chunks reference it instead of the spill buffer. If 
+        analysis_rate is lower than frame_rate, only one frame of every 
+        frame_rate / analysis_rate is compared with the threshold, so the
+        runs end at multiples of that step. The chunks still have every
+        frame. If writer is given (see SongWriter), it receives the frames
+        of each run, and they are not copied to a spill buffer. Runs 
+        are cut every minute, so a sound or a silence that never ends is
+        delivered in several chunks. If meter is given (see LevelMeter), 
+        it receives every block read
+        """
+
+        #default threshold is absolute silence
+        if(not self.threshold):
+            self.threshold = (0,) * channels
+
+        #build compare function
+        self.compare = self._make_compare(sample_width, channels, self.threshold)
+
+        if(path or writer):
+            self.spill = DirectReference(path, channels, sample_width, 
+                frame_rate, offset)
+        else:
+            self.spill = SpillBuffer(channels, sample_width, frame_rate)
+        self.writer = writer
+        if(writer):
+            writer.start(channels, sample_width, frame_rate)
+        self.meter = meter
+        if(meter):
+            meter.start(channels, sample_width, frame_rate)
+        self.block_size = block_size
+        self._frame_size = channels * sample_width
+        self._step = max(frame_rate // analysis_rate, 1) if(analysis_rate) else 1
+        self._max_run = frame_rate * 60
+        self._lookahead = b''
+        self._position = 0
+        self._eof = False
+
+
+    def _read_run(self):
+        """Reads from self.audio the next run of frames that are all under
+        or all over the threshold, copies them to the spill buffer and 
+        returns the chunk. Returns None if there are no more frames. 
+        self.audio can be anything with a readframes method.
+        """
+
+        path, offset = self.spill.begin()
+        frame_size = self._frame_size
+        stride = frame_size * self._step
+        under = None
+        size = 0
+
+        while(not self.isStopped()):
+
+            #refill the lookahead buffer
+            if(self._position >= len(self._lookahead)):
+                self._lookahead = self.audio.readframes(self.block_size)
+                self._position = 0
+
+                #incomplete frames can only be found at the end of stream
+                end = len(self._lookahead) - len(self._lookahead) % frame_size
+                self._lookahead = self._lookahead[:end]
+
+                if(not self._lookahead):
+                    self._eof = True
+                    break
+
+                if(self.meter):
+                    self.meter.add(self._lookahead)
+
+            data = self._lookahead
+            start = position = self._position
+
+            #the first frame decides the type of the run
+            if(under is None):
+                under = self.compare(data[position:position + frame_size]) == True
+
+            while(position < len(data) and 
+                (self.compare(data[position:position + frame_size]) == True) == under):
+                position += stride
+
+            #the step may go past the end of the buffer
+            position = min(position, len(data))
+
+            self.spill.write(data[start:position])
+            if(self.writer):
+                self.writer.write(data[start:position], under)
+            size += (position - start) // frame_size
+            self._position = position
+
+            #the run ended inside the buffer, or it's too long
+            if(position < len(data) or size >= self._max_run):
+                break
+
+        if(not size):
+            return None
+
+        Metrics.count('frames_scanned', size)
+        Metrics.count('chunks')
+
+        return Chunk(offset, size, under, not under, path, 
+            self.spill.channels, self.spill.sample_width, 
+            self.spill.frame_rate)
+
+
+class SongAssembler(object):
+    """Groups consecutive chunks into songs. A song ends with a chunk 
+    under the threshold longer than max_silence_length seconds, because 
+    songs may have short moments of silence. Songs shorter than 
+    min_song_length seconds are discarded. song_callback receives the 
+    list of chunks of each song. The lengths are measured with the frame
+    rate of each chunk, unless frame_rate is given. Consecutive chunks of
+    the same file are merged, so a long song is a short list.
+
+    If max_song_length is given, a song that reaches it without a long 
+    silence is split at the quietest moment of its last split_window 
+    seconds (see quietest_frame), reading them again from the chunks, 
+    and the rest starts the next song
+    """
+
+    def __init__(self, song_callback=None, frame_rate=None, 
+        max_silence_length=0.2, min_song_length=1, max_song_length=None, 
+        split_window=30):
+
+        self.song_callback = song_callback
+        self.frame_rate = frame_rate
+        self.max_silence_length = max_silence_length
+        self.min_song_length = min_song_length
+        self.max_song_length = max_song_length
+        self.split_window = split_window
+        self.chunks = []
+
+    def add(self, chunk):
+
+        frame_rate = self.frame_rate or chunk.frame_rate
+
+        if(chunk.under and chunk.size > frame_rate * self.max_silence_length):
+            #Check that chunks are not empty(to dismiss the initial silence)
+            if(any([c.over for c in self.chunks])):
+                self.flush()
+                return
+
+            #a silence that never ends only keeps its last part
+            self.chunks = []
+
+        last = self.chunks[-1] if(self.chunks) else None
+        if(last and last.path == chunk.path and last.offset + last.size == chunk.offset):
+            self.chunks[-1] = last._replace(size=last.size + chunk.size, 
+                under=last.under and chunk.under, over=last.over or chunk.over)
+        else:
+            self.chunks.append(chunk)
+
+        if(self.max_song_length):
+            limit = int(frame_rate * self.max_song_length)
+            while(sum([c.size for c in self.chunks]) >= limit):
+                self._split(limit, frame_rate)
+
+    def flush(self):
+        """Ends the current song, e.g. when the source is exhausted
+        """
+
+        chunks, self.chunks = self.chunks, []
+
+        #save song if it is long enough
+        length = sum([c.size / float(self.frame_rate or c.frame_rate) for c in chunks])
+        if(length > self.min_song_length):
+            Metrics.count('songs')
+            if(callable(self.song_callback)):
+                self.song_callback(chunks)
+
+    def _split(self, limit, frame_rate):
+        window = min(int(frame_rate * self.split_window), limit // 2)
+        head, tail = split_chunks(self.chunks, limit - window)
+        window_chunks = split_chunks(tail, window)[0]
+
+        c = window_chunks[0]
+        data = b''.join(iter_chunklist(window_chunks))
+        split = limit - window + quietest_frame(data, c.sample_width, 
+            c.channels, c.frame_rate)
+
+        self.chunks, tail = split_chunks(self.chunks, split)
+        self.flush()
+        self.chunks = tail
+        Metrics.count('songs_split')
+
+
+class SongWriter(object):
+    """Assembles the songs like SongAssembler while the frames are read,
+    and writes them with encoder as they arrive, instead of exporting 
+    them once they end. write receives the frames of each run with 
+    whether they are under the threshold. Silences are kept in memory 
+    until they are longer than max_silence_length, which ends the song,
+    or some sound follows them. Songs are written to a hidden file in 
+    output_directory, renamed to prefix_time.extension when they end, or
+    removed if they are shorter than min_song_length seconds. 
+    song_callback receives the path, the size and the analyzer of each 
+    song. analyzer is called when a song starts and the object it 
+    returns receives every block written (add), e.g. an Envelope. 
+    Unlike SongAssembler, the silence before the first song is not part
+    of it. If max_song_length is given, the last split_window seconds 
+    are held in memory before being written, so a song that reaches 
+    max_song_length can be split at their quietest moment like 
+    SongAssembler does
+    """
+
+    def __init__(self, encoder, output_directory, song_callback=None, 
+        max_silence_length=0.2, min_song_length=1, prefix='unknown', 
+        analyzer=None, max_song_length=None, split_window=30):
+
+        self.encoder = encoder
+        self.output_directory = output_directory
+        self.song_callback = song_callback
+        self.max_silence_length = max_silence_length
+        self.min_song_length = min_song_length
+        self.prefix = prefix
+        self.analyzer = analyzer
+        self.max_song_length = max_song_length
+        self.split_window = split_window
+
+        self._stream = None
+        self._silence = []
+        self._silence_frames = 0
+        self._tail = []
+        self._tail_frames = 0
+
+    def start(self, channels, sample_width, frame_rate):
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self._frame_size = channels * sample_width
+
+        self._limit = None
+        self._window = 0
+        if(self.max_song_length):
+            self._limit = int(frame_rate * self.max_song_length)
+            self._window = min(int(frame_rate * self.split_window), self._limit // 2)
+
+    def write(self, data, under):
+
+        if(under):
+            #silences before the first sound are dismissed
+            if(not self._stream):
+                return
+
+            self._silence.append(data)
+            self._silence_frames += len(data) // self._frame_size
+
+            if(self._silence_frames > self.frame_rate * self.max_silence_length):
+                self._end()
+            return
+
+        if(not self._stream):
+            self._begin()
+
+        #the silence was short, it's part of the song
+        for block in self._silence:
+            self._write(block)
+        self._silence = []
+        self._silence_frames = 0
+
+        self._write(data)
+
+    def close(self):
+        """Ends the current song, e.g. when the source is exhausted. Like 
+        SongAssembler.flush, it keeps the last short silence
+        """
+        if(self._stream):
+            for block in self._silence:
+                self._write(block)
+            self._end()
+
+    def _begin(self):
+        self._time = time.time()
+        self._frames = 0
+        self._path = os.path.join(self.output_directory, '.{}_{}.{}.part'.format(
+            self.prefix, self._time, self.encoder.extension))
+        self._stream = self.encoder.open(self._path, self.channels, 
+            self.sample_width, self.frame_rate)
+        self._analyzer = self.analyzer() if(self.analyzer) else None
+
+    def _write(self, data):
+        self._tail.append(data)
+        self._tail_frames += len(data) // self._frame_size
+
+        while(self._limit and self._frames + self._tail_frames >= self._limit):
+            self._split()
+
+        #only the last window is held in memory
+        while(self._tail and self._tail_frames - len(self._tail[0]) // self._frame_size >= self._window):
+            block = self._tail.pop(0)
+            self._tail_frames -= len(block) // self._frame_size
+            self._write_block(block)
+
+    def _write_block(self, data):
+        if(not data):
+            return
+
+        self._stream.write(data)
+        self._frames += len(data) // self._frame_size
+        Metrics.count('export_bytes', len(data))
+        if(self._analyzer):
+            self._analyzer.add(data)
+
+    def _split(self):
+        """Ends the song at the quietest moment of the window before
+        max_song_length and starts the next one with the rest
+        """
+
+        frame_size = self._frame_size
+        data = b''.join(self._tail)
+        self._tail = []
+        self._tail_frames = 0
+
+        end = self._limit - self._frames
+        start = max(end - self._window, 0)
+        split = start + quietest_frame(data[start * frame_size:end * frame_size], 
+            self.sample_width, self.channels, self.frame_rate)
+
+        self._write_block(data[:split * frame_size])
+        self._finish()
+        self._begin()
+
+        rest = data[split * frame_size:]
+        if(rest):
+            self._tail = [rest]
+            self._tail_frames = len(rest) // frame_size
+        Metrics.count('songs_split')
+
+    def _end(self):
+        for block in self._tail:
+            self._write_block(block)
+        self._tail = []
+        self._tail_frames = 0
+        self._silence = []
+        self._silence_frames = 0
+
+        self._finish()
+
+    def _finish(self):
+        stream, self._stream = self._stream, None
+
+        if(self._frames <= self.frame_rate * self.min_song_length):
+            stream.abort()
+            return
+
+        size = stream.close()
+        Metrics.count('export_encoded_bytes', size)
+        path = os.path.join(self.output_directory, '{}_{}.{}'.format(
+            self.prefix, self._time, self.encoder.extension))
+        os.rename(self._path, path)
+
+        Metrics.count('songs')
+        if(callable(self.song_callback)):
+            self.song_callback(path, size, self._analyzer)
+
+
 class FromFile(AudioWorker):
+    """Extracts chunks from an audio file. update_callback receives each
+    chunk, or lists of up to batch_size chunks if batch_size is greater 
+    than 1. progress_callback receives a ProgressInfo at most every 
+    progress_interval seconds and once more at the end, so the scan does
+    not spend its time computing and delivering progress. The pending 
+    batch is delivered before each progress.
+
+    If max_silence_length is given, wav files are scanned coarse to fine:
+    blocks of block_length seconds are tested as a whole, and only the 
+    frames around runs of silent blocks that may be a silence longer than
+    max_silence_length are compared one by one, to find its exact first
+    and last frames. Only those silences are delivered as chunks under
+    the threshold, the audio between them is delivered in chunks over 
+    the threshold, so SongAssembler gives the same songs as with every
+    run
+
+    Formats other than wav are decoded with audioread while they are 
+    scanned, and their chunks reference temporary spill segments instead
+    of the input. discard_spill deletes the segments of the songs 
+    already exported, and the rest are deleted once stop_callback 
+    returns, so the songs must be exported by then
+    """
 
-    def __init__(self, input_path, threshold=None, update_callback=None, stop_callback=None):
+    def __init__(self, input_path, threshold=None, update_callback=None, 
+        stop_callback=None, progress_callback=None, progress_interval=0.5, 
+        batch_size=1, max_silence_length=None, block_length=0.005):
         AudioWorker.__init__(self)
 
         self.input_path = input_path
         self.threshold = threshold
         self.update_callback = update_callback
         self.stop_callback = stop_callback
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.batch_size = batch_size
+        self.max_silence_length = max_silence_length
+        self.block_length = block_length
+        self.coarse = False
         self.ProgressInfo = namedtuple('ProgressInfo', 'currentFrame totalFrames currentTime totalTime percent')
 
+        self._batch = []
+        self._last_progress = 0
+
     def on_start(self):
 
-        self.audio = wave.open(self.input_path, 'r')
+        #wav files are read directly, other formats are decoded on the fly
+        try:
+            self.audio = wave.open(self.input_path, 'r')
+            self.decoded = False
+        except (wave.Error, EOFError):
+            if(not have_audioread):
+                raise
+            self.audio = DecodedAudio(self.input_path)
+            self.decoded = True
+
+        if(self.decoded):
+            #decoded frames can not be read again from the input file, so
+            #the chunks reference the spill buffer
+            self._start_stream(self.audio.getnchannels(), 
+                self.audio.getsampwidth(), self.audio.getframerate())
+            return
 
         #default threshold is absolute silence
         if(not self.threshold):
@@ -148,9 +1279,29 @@ class FromFile(AudioWorker):
             self.threshold
         )
 
+        if(self.max_silence_length is not None):
+            self.coarse = self._start_coarse(self.audio.getnchannels(), 
+                self.audio.getsampwidth(), self.audio.getframerate(), 
+                self.max_silence_length, self.block_length)
+
 
     def loop(self):
 
+        if(self.decoded):
+            chunk = self._read_run()
+
+            if(chunk):
+                self._deliver(chunk)
+
+            if(self._eof):
+                self.stop()
+
+            return
+
+        if(self.coarse):
+            self._scan_coarse()
+            return
+
         offset = self.audio.tell()
 
         #it's inclusive. means frame <= threshold
@@ -171,18 +1322,10 @@ class FromFile(AudioWorker):
             under, not under, self.input_path, self.audio.getnchannels(),
             self.audio.getsampwidth(), self.audio.getframerate())
 
+        Metrics.count('frames_scanned', chunk.size)
+        Metrics.count('chunks')
 
-        #call progress function if exists
-        if(callable(self.update_callback)):
-
-            self.update_callback(chunk, self.ProgressInfo(
-                self.audio.tell(),
-                self.audio.getnframes(),
-                self.audio.tell() * self.audio.getframerate(),
-                self.audio.getnframes() * self.audio.getframerate(),
-                #the +1 is for the last frame(the empty frame)
-                (self.audio.tell() + 1) * 100 / self.audio.getnframes()
-            ))
+        self._deliver(chunk)
 
         #means if end of wav because last frame is empty
         if(self.audio.tell() == self.audio.getnframes() - 1):
@@ -190,13 +1333,223 @@ class FromFile(AudioWorker):
 
     def on_stop(self):
 
+        #the last batch and the final progress
+        self._flush()
+        if(callable(self.progress_callback)):
+            self.progress_callback(self._progress())
+
         self.audio.close()
+
+        if(self.decoded):
+            self.spill.close()
         
         #call the callback if exists
-        if(callable(self.stop_callback)):
-            self.stop_callback()
+        try:
+            if(callable(self.stop_callback)):
+                self.stop_callback()
+        finally:
+            #the decoded audio is not left on disk
+            if(self.decoded):
+                self.spill.remove()
+
+    def _scan_coarse(self):
+        """Reads the next blocks and tests them as a whole
+        """
+
+        position = self.audio.tell()
+        data = self.audio.readframes(self.block * 64)
+
+        self._scan_blocks(position, data)
+
+        if(not data):
+            self.stop()
+
+    def _coarse_chunk(self, offset, size, under):
+        Metrics.count('chunks')
+        self._deliver(Chunk(offset, size, under, not under, self.input_path, 
+            self.audio.getnchannels(), self.audio.getsampwidth(), 
+            self.audio.getframerate()))
+
+    def _deliver(self, chunk):
+        if(self.batch_size > 1):
+            self._batch.append(chunk)
+            if(len(self._batch) >= self.batch_size):
+                self._flush()
+        elif(callable(self.update_callback)):
+            self.update_callback(chunk)
+
+        if(callable(self.progress_callback)):
+            now = time.time()
+            if(now - self._last_progress >= self.progress_interval):
+                self._last_progress = now
+                self._flush()
+                self.progress_callback(self._progress())
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        if(batch and callable(self.update_callback)):
+            self.update_callback(batch)
+
+    def _progress(self):
+        return self.ProgressInfo(
+            self.audio.tell(),
+            self.audio.getnframes(),
+            self.audio.tell() / float(self.audio.getframerate()),
+            self.audio.getnframes() / float(self.audio.getframerate()),
+            #the +1 is for the last frame(the empty frame). The total 
+            #frames of decoded files are estimated, so it's limited to 100
+            min((self.audio.tell() + 1) * 100 // self.audio.getnframes(), 100)
+        )
+
+
+class FromStream(AudioWorker):
+    """Extracts chunks from a wav stream that is not seekable, like the 
+    standard input or a socket. '-' means the standard input, so audio 
+    can be piped from other tools, e.g. ffmpeg -i song.mp3 -f wav -
+    stream can also be anything with the reading methods of the wave 
+    module, like DecodedAudio or SystemInput. The chunks are delivered 
+    as soon as each run ends and reference the spill buffer, or path if
+    the frames can be read again from that wav file, so memory usage 
+    does not depend on the stream length. offset is the position of the
+    first frame of the stream in path. analysis_rate limits the frames 
+    per second compared with the threshold (see _start_stream), e.g. to
+    analyze 96kHz sources at a fraction of the cost. If writer is given,
+    it writes the songs while the stream is read (see SongWriter). If 
+    meter is given, it publishes the levels of the stream (see 
+    LevelMeter)
+
+    If max_silence_length is given and the frames can be read again from
+    path, the stream is scanned coarse to fine like FromFile does, unless
+    there is a writer or an analysis_rate
+
+    The spill buffer is deleted once stop_callback returns, so the songs
+    must be exported by then, unless remove_spill is False and the owner
+    deletes it (see AudioWorker.discard_spill and SpillBuffer.remove)
+    """
+
+    def __init__(self, stream='-', threshold=None, update_callback=None, 
+        stop_callback=None, block_size=1024, path=None, offset=0, 
+        analysis_rate=None, writer=None, meter=None, 
+        max_silence_length=None, block_length=0.005, remove_spill=True):
+        AudioWorker.__init__(self)
+
+        self.stream = stream
+        self.threshold = threshold
+        self.update_callback = update_callback
+        self.stop_callback = stop_callback
+        self.block_size = block_size
+        self.path = path
+        self.offset = offset
+        self.analysis_rate = analysis_rate
+        self.writer = writer
+        self.meter = meter
+        self.max_silence_length = max_silence_length
+        self.block_length = block_length
+        self.remove_spill = remove_spill
+        self.coarse = False
+
+    def on_start(self):
+
+        if(hasattr(self.stream, 'readframes')):
+            self.audio = self.stream
+        else:
+            self.audio, self.path = open_input(self.stream)
+
+        self._start_stream(self.audio.getnchannels(), 
+            self.audio.getsampwidth(), self.audio.getframerate(), 
+            self.block_size, self.path, self.offset, self.analysis_rate, 
+            self.writer, self.meter)
+
+        #the runs are needed by the writer and follow the analysis rate
+        if(self.max_silence_length is not None and self.path and 
+            not self.writer and not self.analysis_rate):
+            self.coarse = self._start_coarse(self.audio.getnchannels(), 
+                self.audio.getsampwidth(), self.audio.getframerate(), 
+                self.max_silence_length, self.block_length)
+            self._read = 0          #frames read from the stream
+
+    def loop(self):
+
+        if(self.coarse):
+            chunks = self._read_blocks()
+        else:
+            chunk = self._read_run()
+            chunks = [chunk] if(chunk) else []
+
+        #execute callback if it exists
+        for chunk in chunks:
+            if(callable(self.update_callback)):
+                self.update_callback(chunk)
+
+        if(self._eof):
+            self.stop()
+
+    def _read_blocks(self):
+        """Coarse to fine version of _read_run. Reads the next frames and 
+        returns the chunks that ended in them. The frames after the last
+        whole block wait in the lookahead buffer for the next read
+        """
+
+        self._chunks = []
+
+        data = self.audio.readframes(self.block_size)
+        data = data[:len(data) - len(data) % self._frame_size]
+        if(data and self.meter):
+            self.meter.add(data)
+
+        if(data):
+            data = self._lookahead + data
+            end = len(data) - len(data) % (self.block * self._frame_size)
+            data, self._lookahead = data[:end], data[end:]
+        else:
+            data, self._lookahead = self._lookahead, b''
+            self._eof = True
+
+        position = self._read
+        self._read += len(data) // self._frame_size
+        self._scan_blocks(position, data)
+
+        if(self._eof):
+            self._scan_blocks(self._read, b'')
+
+        #a sound that never ends is delivered every minute, like the runs
+        elif(self._run is None and self._read - self._start >= self._max_run):
+            self._coarse_chunk(self._start, self._read - self._start, False)
+            self._start = self._read
+
+        return self._chunks
+
+    def _coarse_chunk(self, offset, size, under):
+        Metrics.count('chunks')
+        self._chunks.append(Chunk(self.offset + offset, size, under, 
+            not under, self.path, self.audio.getnchannels(), 
+            self.audio.getsampwidth(), self.audio.getframerate()))
+
+    def on_stop(self):
+
+        try:
+            self.audio.close()
+            self.spill.close()
+
+            #the song in progress ends with the stream
+            if(self.writer):
+                self.writer.close()
+        finally:
+            #call the callback if it exists, even after an error
+            try:
+                if(callable(self.stop_callback)):
+                    self.stop_callback()
+            finally:
+                #the stream is not left on disk
+                if(self.remove_spill and hasattr(self.spill, 'remove')):
+                    self.spill.remove()
+
 
 class FromSystem(AudioWorker):
+    """Extracts chunks from the system input, read in blocking mode, frame
+    by frame. To capture without input overflows while the analysis 
+    falls behind, use a Pipeline with a SystemInput source
+    """
 
     def __init__(self, channels=1, sample_width=2, frame_rate=44100, 
         threshold=None, update_callback=None, stop_callback=None):
@@ -247,6 +1600,9 @@ class FromSystem(AudioWorker):
         chunk = Chunk(0, audio.getnframes(), under, not under, 
             output_path, self.channels, self.sample_width, self.frame_rate)
 
+        Metrics.count('frames_scanned', chunk.size)
+        Metrics.count('chunks')
+
         audio.close()
 
         #execute callback if it exists
@@ -289,14 +1645,4 @@ class FromSystem(AudioWorker):
     def _get_format(self):
         """converts sample_width from the wave format to pyaudio format
         """
-
-        if(self.sample_width == 1):
-            return pyaudio.paInt8
-        elif(self.sample_width == 2):
-            return pyaudio.paInt16
-        elif(self.sample_width == 3):
-            return pyaudio.paInt24
-        elif(self.sample_width == 4):
-            return pyaudio.paInt32
-            
-        raise SampleWidthException('Invalid sample width')
+        return _get_format(self.sample_width)
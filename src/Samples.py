@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import array
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+
+def _values(data, sample_width):
+    """Unpacks the samples without audioop
+    """
+
+    samples = len(data) // sample_width
+    if(sample_width == 3):
+        #the samples in the high bytes of 4-byte integers keep their sign
+        data = b''.join([b'\x00' + data[i:i + 3] for i in range(0, samples * 3, 3)])
+        return [v >> 8 for v in array.array('i', data)]
+
+    return array.array({1: 'b', 2: 'h', 4: 'i'}[sample_width],
+        data[:samples * sample_width])
+
+
+def energy(data, sample_width):
+    """Returns the sum of the squares of the samples and the number of
+    samples
+    """
+
+    samples = len(data) // sample_width
+    if(not samples):
+        return 0, 0
+
+    if(audioop):
+        try:
+            return audioop.rms(data, sample_width) ** 2 * samples, samples
+        except audioop.error:
+            #3-byte samples need python 3.4 or later
+            pass
+
+    return sum([v * v for v in _values(data, sample_width)]), samples
+
+
+def peak(data, sample_width):
+    """Returns the max absolute value of the samples
+    """
+
+    samples = len(data) // sample_width
+    if(not samples):
+        return 0
+
+    if(audioop):
+        try:
+            return audioop.max(data, sample_width)
+        except audioop.error:
+            pass
+
+    values = _values(data, sample_width)
+    return max(max(values), -min(values))
+
+
+def crossings(data, sample_width, channels):
+    """Returns the number of times the first channel changes its sign and
+    the number of frames. Their ratio grows with the frequencies of the
+    sound, a 440Hz tone crosses zero 880 times per second and white noise
+    about half of the frames
+    """
+
+    frames = len(data) // (sample_width * channels)
+    if(not frames):
+        return 0, 0
+
+    if(audioop):
+        try:
+            if(channels == 2):
+                data = audioop.tomono(data, sample_width, 1, 0)
+            elif(channels > 2):
+                data = None
+            if(data is not None):
+                return audioop.cross(data, sample_width), frames
+        except audioop.error:
+            pass
+
+    values = _values(data, sample_width)[::channels]
+    return sum([1 for x, y in zip(values, values[1:]) if((x < 0) != (y < 0))]), frames
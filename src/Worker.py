@@ -1,30 +1,55 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import sys
+import time
 import threading
 
 class Worker(threading.Thread):
+    """Thread that calls loop until it's stopped. It can be paused and
+    resumed, and a paused worker waits on an event instead of spinning.
+    If on_start, loop or on_stop raise an exception the worker stops,
+    on_error is called and the exception is raised again by wait, so the
+    owner can handle it
+    """
 
     def __init__(self):
         threading.Thread.__init__(self)
-        self._state = threading.Condition()
-        self._paused = False
-        self._stopped = False
+
+        #set while the worker is not paused
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+        #set when stop is requested
+        self._stopping = threading.Event()
+
+        self.exc_info = None
 
 
     def run(self):
-        self.on_start()
-        
-        while True:
-            with self._state:
-                if self._paused:
-                    self._state.wait()
-            
-            if(self._stopped):
-                break
+        try:
+            self.on_start()
+        except Exception as e:
+            self._fail(e)
+            return
+
+        try:
+            while True:
+                #stop also sets the resumed event to wake up a paused worker
+                self._resumed.wait()
 
-            self.loop()
+                if(self._stopping.is_set()):
+                    break
 
-        self.on_stop()
+                start = time.time()
+                self.loop()
+                self.on_iteration(time.time() - start)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            try:
+                self.on_stop()
+            except Exception as e:
+                self._fail(e)
 
 
     def on_start(self):
@@ -32,24 +57,60 @@ class Worker(threading.Thread):
 
     def on_stop(self):
         pass
-            
+
+    def on_iteration(self, elapsed):
+        """Called after each loop with the time it took in seconds
+        """
+        pass
+
+    def on_error(self, exception):
+        """Called from the worker thread when it dies with an exception
+        """
+        pass
+
     def isPaused(self):
-        return self._paused
-            
+        return not self._resumed.is_set()
+
     def isStopped(self):
-        return self._stopped
+        return self._stopping.is_set()
 
     def resume(self):
-        with self._state:
-            self._paused = False
-            self._state.notify()  # unblock self if waiting
+        self._resumed.set()
 
     def pause(self):
-        with self.state:
-            self._paused = True
+        self._resumed.clear()
 
     def stop(self):
-        self._stopped = True
+        self._stopping.set()
+        self._resumed.set()
+
+    def sleep(self, seconds):
+        """Waits without spinning. Returns True if the worker was stopped
+        in the meantime
+        """
+        return self._stopping.wait(seconds)
+
+    def wait(self, timeout=None):
+        """Joins the worker. Returns False if it's still running after
+        timeout seconds. If the worker died with an exception, it's raised
+        again here
+        """
+        self.join(timeout)
+
+        if(self.is_alive()):
+            return False
+
+        if(self.exc_info):
+            raise self.exc_info[1]
+
+        return True
 
     def loop(self):
         raise NotImplementedError("Please Implement this method")
+
+    def _fail(self, exception):
+        #keep only the first exception, the rest are usually consequences
+        if(not self.exc_info):
+            self.exc_info = sys.exc_info()
+        self._stopping.set()
+        self.on_error(exception)
@@ -30,11 +30,29 @@ try:
     have_chromaprint = True
 except ImportError:
     have_chromaprint = False
+try:
+    import audioop
+except ImportError:
+    audioop = None
 import subprocess
 import threading
 import time
 import gzip
+import wave
+import zlib
+import random
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
 from io import BytesIO
+from collections import OrderedDict
+
+import Metrics
 
 
 API_BASE_URL = 'http://api.acoustid.org/v2/'
@@ -43,6 +61,25 @@ REQUEST_INTERVAL = 0.33 # 3 requests/second.
 MAX_AUDIO_LENGTH = 120 # Seconds.
 FPCALC_COMMAND = 'fpcalc'
 FPCALC_ENVVAR = 'FPCALC'
+WAVE_BLOCK_FRAMES = 65536 # Frames read at once from WAV files.
+LOOKUP_CACHE_SIZE = 256 # Responses kept, 0 disables the cache.
+CONNECT_TIMEOUT = 3.05 # Seconds.
+READ_TIMEOUT = 10 # Seconds.
+REQUEST_DEADLINE = 30 # Seconds for a request and its retries, 0 for none.
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5 # Seconds before the first retry, doubled each time.
+HEDGE_DELAY = None # Seconds before a duplicate request, None disables.
+POOL_SIZE = 10 # Connections kept open to the Web service.
+BREAKER_FAILURES = 5 # Consecutive failures that open the circuit.
+BREAKER_RESET = 30 # Seconds before retrying a service that is down.
+SUBMIT_BATCH_SIZE = 100 # Fingerprints per batched submission.
+SUBMIT_BATCH_BYTES = 1024 * 1024 # Form data per batched submission.
+SUBMIT_BATCH_DELAY = 30 # Seconds a fingerprint waits for a full batch.
+COMPRESS_BLOCK_SIZE = 65536 # Bytes of form data compressed at once.
+
+# Error codes of the Web service.
+ERROR_INTERNAL = 5
+ERROR_RATE_LIMIT = 14
 
 
 # Exceptions.
@@ -93,6 +130,13 @@ class WebServiceError(AcoustidError):
         self.message = message
 
 
+class ServiceUnavailableError(WebServiceError):
+    """The Web service could not be reached or was overloaded, even
+    after retrying, or the circuit breaker is open. The same request may
+    succeed later.
+    """
+
+
 # Endpoint configuration.
 
 def set_base_url(url):
@@ -123,11 +167,50 @@ def _compress(data):
     return sio.getvalue()
 
 
+def _encode_params(params):
+    """Generate the form encoding of the parameters piece by piece, so
+    a large body is never built as a whole.
+    """
+    for i, (key, value) in enumerate(sorted(params.items())):
+        if not isinstance(value, bytes):
+            value = u'{0}'.format(value).encode('utf8')
+        piece = urlencode([(key, value)])
+        if not isinstance(piece, bytes):
+            piece = piece.encode('ascii')
+        yield piece if i == 0 else b'&' + piece
+
+
+def _compress_params(params):
+    """Form-encode the parameters and compress them to a gzip archive
+    in a stream: the uncompressed body is fed to the compressor in
+    blocks of COMPRESS_BLOCK_SIZE bytes and only the compressed one is
+    kept in memory.
+    """
+    # A window of 16 + MAX_WBITS writes a gzip header.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    output = []
+    block = []
+    size = 0
+    for piece in _encode_params(params):
+        block.append(piece)
+        size += len(piece)
+        if size >= COMPRESS_BLOCK_SIZE:
+            output.append(compressor.compress(b''.join(block)))
+            block = []
+            size = 0
+    output.append(compressor.compress(b''.join(block)))
+    output.append(compressor.flush())
+    return b''.join(output)
+
+
 class CompressedHTTPAdapter(requests.adapters.HTTPAdapter):
     """An `HTTPAdapter` that compresses request bodies with gzip. The
-    Content-Encoding header is set accordingly.
+    Content-Encoding header is set accordingly. Bodies that are already
+    compressed are left as they are.
     """
     def add_headers(self, request, **kwargs):
+        if 'Content-Encoding' in request.headers:
+            return
         body = request.body
         if not isinstance(body, bytes):
             body = body.encode('utf8')
@@ -135,14 +218,85 @@ class CompressedHTTPAdapter(requests.adapters.HTTPAdapter):
         request.headers['Content-Encoding'] = 'gzip'
 
 
+# Recording and replaying responses.
+
+class _Replay(object):
+    """Stores Web service responses in a JSON lines file, keyed by the
+    endpoint and the request parameters (except the API keys).
+    """
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError('mode must be record or replay')
+        self.path = path
+        self.mode = mode
+        self.responses = {}
+        self.lock = threading.Lock()
+
+        if mode == 'replay':
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        key = self.key(entry['endpoint'], entry['params'])
+                        self.responses[key] = entry['response']
+
+    @staticmethod
+    def params(params):
+        """The parameters that are recorded, with bytes values, like
+        the fingerprints of chromaprint and fpcalc on Python 3, decoded
+        so they can be serialized.
+        """
+        return dict((k, v.decode('utf8') if isinstance(v, bytes) else v)
+                    for k, v in params.items()
+                    if k not in ('client', 'user'))
+
+    @classmethod
+    def key(cls, endpoint, params):
+        return endpoint, json.dumps(cls.params(params), sort_keys=True)
+
+    def get(self, url, params):
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+        try:
+            return self.responses[self.key(endpoint, params)]
+        except KeyError:
+            raise WebServiceError('no recorded response')
+
+    def add(self, url, params, response):
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+        line = json.dumps({'endpoint': endpoint,
+                           'params': self.params(params),
+                           'response': response}, sort_keys=True)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+_replay = None
+
+
+def set_replay(path, mode='replay'):
+    """Record every Web service response to the file at ``path``
+    (``mode='record'``), or answer the requests from a recorded file
+    without using the network (``mode='replay'``). Requests without a
+    recorded response raise a WebServiceError. A ``path`` of None
+    disables both.
+    """
+    global _replay
+    _replay = _Replay(path, mode) if path else None
+
+
 # Utilities.
 
 class _rate_limit(object):
     """A decorator that limits the rate at which the function may be
     called.  The rate is controlled by the REQUEST_INTERVAL module-level
     constant; set the value to zero to disable rate limiting. The
-    limiting is thread-safe; only one thread may be in the function at a
-    time (acts like a monitor in this sense).
+    limiting is thread-safe; each call reserves the next free slot and
+    waits for it outside the lock, so a slow call does not hold back
+    the following ones. A call may pass its ``deadline``, a time or
+    None, as a keyword argument; if its slot is not before the deadline
+    it raises a ServiceUnavailableError without waiting or taking the
+    slot.
     """
     def __init__(self, fun):
         self.fun = fun
@@ -150,41 +304,257 @@ class _rate_limit(object):
         self.lock = threading.Lock()
 
     def __call__(self, *args, **kwargs):
+        deadline = kwargs.get('deadline')
         with self.lock:
-            # Wait until request_rate time has passed since last_call,
-            # then update last_call.
-            since_last_call = time.time() - self.last_call
-            if since_last_call < REQUEST_INTERVAL:
-                time.sleep(REQUEST_INTERVAL - since_last_call)
-            self.last_call = time.time()
+            # Reserve the slot REQUEST_INTERVAL after the last one.
+            now = time.time()
+            slot = max(now, self.last_call + REQUEST_INTERVAL)
+            if deadline is not None and slot >= deadline:
+                raise ServiceUnavailableError('deadline exceeded')
+            self.last_call = slot
+
+        if slot > now:
+            time.sleep(slot - now)
+            Metrics.observe('rate_limit_wait', slot - now)
+
+        # Call the original function.
+        return self.fun(*args, **kwargs)
+
+
+class _CircuitBreaker(object):
+    """Fails fast while the Web service is down. After BREAKER_FAILURES
+    consecutive requests failed, even after their retries, the circuit
+    opens and requests raise a ServiceUnavailableError without using
+    the network. After BREAKER_RESET seconds one request is let through;
+    the circuit closes if it succeeds and opens again if it fails.
+    """
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
 
-            # Call the original function.
-            return self.fun(*args, **kwargs)
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if self.probing or time.time() - self.opened < BREAKER_RESET:
+                Metrics.count('breaker_rejections')
+                raise ServiceUnavailableError(
+                    'service unavailable (circuit open)')
+            self.probing = True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (BREAKER_FAILURES and
+                                self.failures >= BREAKER_FAILURES):
+                if self.opened is None:
+                    Metrics.count('breaker_opened')
+                self.opened = time.time()
+            self.probing = False
+
+
+_breaker = _CircuitBreaker()
+
+
+class _RetryableError(WebServiceError):
+    """A request failed in a way that may succeed if it is repeated.
+    ``sent`` is False if the request surely did not reach the service.
+    """
+    def __init__(self, message, sent=True):
+        super(_RetryableError, self).__init__(message)
+        self.sent = sent
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    """Get the session shared by every request, hedged ones included,
+    so their connections are reused. It is created on first use, with a
+    pool of POOL_SIZE connections per host.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def _timeouts(deadline):
+    """Returns the connect and read timeouts of a request that must end
+    by ``deadline``, a time or None. Raises a ServiceUnavailableError if
+    the deadline passed.
+    """
+    connect, read = CONNECT_TIMEOUT, READ_TIMEOUT
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ServiceUnavailableError('deadline exceeded')
+        connect, read = min(connect, remaining), min(read, remaining)
+    return connect, read
 
 
 @_rate_limit
-def _api_request(url, params):
+def _send(url, params, deadline=None):
     """Makes a POST request for the URL with the given form parameters,
-    which are encoded as compressed form data, and returns a parsed JSON
-    response. May raise a WebServiceError if the request fails.
+    which are encoded as compressed form data (see _compress_params),
+    and returns a parsed JSON response. The request never waits past
+    ``deadline``, counting the wait for its rate limit slot. Raises a
+    _RetryableError for timeouts, connection errors and server-side
+    errors.
     """
     headers = {
         'Accept-Encoding': 'gzip',
+        'Content-Encoding': 'gzip',
         "Content-Type": "application/x-www-form-urlencoded"
     }
+    body = _compress_params(params)
+    Metrics.count('request_bytes', len(body))
 
-    session = requests.Session()
-    session.mount('http://', CompressedHTTPAdapter())
+    # The timeouts are what is left after the rate limit wait.
+    timeout = _timeouts(deadline)
+    session = _get_session()
     try:
-        response = session.post(url, data=params, headers=headers)
+        with Metrics.timer('request'):
+            response = session.post(url, data=body, headers=headers,
+                                    timeout=timeout)
+    except requests.exceptions.ConnectTimeout as exc:
+        raise _RetryableError("HTTP request failed: {0}".format(exc), False)
+    except requests.exceptions.ConnectionError as exc:
+        raise _RetryableError("HTTP request failed: {0}".format(exc),
+                              'Connection refused' not in str(exc))
+    except requests.exceptions.Timeout as exc:
+        raise _RetryableError("HTTP request failed: {0}".format(exc))
     except requests.exceptions.RequestException as exc:
         raise WebServiceError("HTTP request failed: {0}".format(exc))
 
     try:
-        return response.json()
+        data = response.json()
     except ValueError:
+        if response.status_code >= 500:
+            raise _RetryableError("HTTP status %i" % response.status_code)
         raise WebServiceError('response is not valid JSON')
 
+    error = data.get('error') if isinstance(data, dict) else None
+    code = error.get('code') if isinstance(error, dict) else None
+    if code == ERROR_RATE_LIMIT:
+        raise _RetryableError(error.get('message', 'rate limit'), False)
+    if response.status_code >= 500 or code == ERROR_INTERNAL:
+        raise _RetryableError(error.get('message', 'internal error')
+                              if error else
+                              "HTTP status %i" % response.status_code)
+    return data
+
+
+def _hedged_send(url, params, deadline):
+    """Like _send, but if there is no response after HEDGE_DELAY
+    seconds the same request is sent again and the first response is
+    returned.
+    """
+    results = queue.Queue()
+
+    def run():
+        try:
+            results.put((True, _send(url, params, deadline=deadline)))
+        except Exception as exc:
+            results.put((False, exc))
+
+    def start():
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    start()
+    try:
+        ok, value = results.get(timeout=HEDGE_DELAY)
+        pending = 0
+    except queue.Empty:
+        Metrics.count('hedged_requests')
+        start()
+        ok, value = results.get()
+        pending = 1
+
+    # Prefer a response over the error of the first request to end.
+    if not ok and pending:
+        ok, value = results.get()
+    if not ok:
+        raise value
+    return value
+
+
+def _retried_send(url, params, deadline, idempotent):
+    """Makes a request with _send, or _hedged_send, retrying it as
+    described in _api_request until ``deadline``, a time or None.
+    """
+    attempt = 0
+    while True:
+        try:
+            if HEDGE_DELAY and idempotent:
+                return _hedged_send(url, params, deadline)
+            else:
+                return _send(url, params, deadline=deadline)
+        except _RetryableError as exc:
+            backoff = RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+            if (attempt >= MAX_RETRIES or (exc.sent and not idempotent) or
+                    (deadline is not None and
+                     time.time() + backoff >= deadline)):
+                raise ServiceUnavailableError(exc.message)
+            Metrics.count('request_retries')
+            time.sleep(backoff)
+            attempt += 1
+
+
+def _api_request(url, params, timeout=None, idempotent=True):
+    """Makes a request with _send and returns the parsed JSON response,
+    or the recorded one in replay mode. Timeouts, connection errors and
+    server-side errors are retried up to MAX_RETRIES times after a
+    jittered exponential backoff; requests that are not ``idempotent``
+    are only retried if they did not reach the service. Idempotent
+    requests are hedged if HEDGE_DELAY is set. ``timeout`` bounds the
+    whole call in seconds, REQUEST_DEADLINE by default. May raise a
+    WebServiceError if the request fails, a ServiceUnavailableError if
+    it may succeed later.
+    """
+    replay = _replay
+    if replay and replay.mode == 'replay':
+        return replay.get(url, params)
+
+    if timeout is None:
+        timeout = REQUEST_DEADLINE
+    deadline = time.time() + timeout if timeout else None
+
+    # The breaker is checked once per call, not per attempt, and every
+    # call it lets through settles it, so a probe always closes or opens
+    # the circuit again.
+    _breaker.check()
+    succeeded = False
+    try:
+        data = _retried_send(url, params, deadline, idempotent)
+        succeeded = True
+    finally:
+        if succeeded:
+            _breaker.success()
+        else:
+            _breaker.failure()
+
+    if replay:
+        replay.add(url, params, data)
+    return data
+
 
 # Main API.
 
@@ -213,10 +583,21 @@ def fingerprint(samplerate, channels, pcmiter, maxlength=MAX_AUDIO_LENGTH):
         raise FingerprintGenerationError("fingerprint calculation failed")
 
 
-def lookup(apikey, fingerprint, duration, meta=DEFAULT_META):
+_lookup_cache = OrderedDict()
+_lookup_cache_lock = threading.Lock()
+
+
+def lookup(apikey, fingerprint, duration, meta=DEFAULT_META, timeout=None):
     """Look up a fingerprint with the Acoustid Web service. Returns the
-    Python object reflecting the response JSON data.
+    Python object reflecting the response JSON data. The last
+    LOOKUP_CACHE_SIZE successful responses are cached, so looking up the
+    same audio again does not use the Web service. ``timeout`` bounds
+    the request and its retries in seconds (see ``_api_request``).
     """
+    # chromaprint and fpcalc give bytes on Python 3.
+    if isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.decode('ascii')
+
     params = {
         'format': 'json',
         'client': apikey,
@@ -224,7 +605,27 @@ def lookup(apikey, fingerprint, duration, meta=DEFAULT_META):
         'fingerprint': fingerprint,
         'meta': meta,
     }
-    return _api_request(_get_lookup_url(), params)
+
+    key = (apikey, fingerprint, int(duration), meta)
+    with _lookup_cache_lock:
+        response = _lookup_cache.pop(key, None)
+        if response is not None:
+            # Move it to the end, as the most recently used.
+            _lookup_cache[key] = response
+            Metrics.count('lookup_cache_hits')
+            return response
+
+    Metrics.count('lookup_cache_misses')
+    with Metrics.timer('lookup'):
+        response = _api_request(_get_lookup_url(), params, timeout)
+
+    if LOOKUP_CACHE_SIZE and response.get('status') == 'ok':
+        with _lookup_cache_lock:
+            _lookup_cache[key] = response
+            while len(_lookup_cache) > LOOKUP_CACHE_SIZE:
+                _lookup_cache.popitem(last=False)
+
+    return response
 
 
 def parse_lookup_result(data):
@@ -267,6 +668,57 @@ def _fingerprint_file_audioread(path, maxlength):
     return duration, fp
 
 
+def _to_16bit(data, sample_width):
+    """Convert PCM samples of a WAV file to the 16-bit samples that
+    chromaprint expects. Returns None if they can not be converted.
+    """
+    if sample_width == 2:
+        return data
+    if audioop is None:
+        return None
+    try:
+        if sample_width == 1:
+            # 8-bit WAV samples are unsigned.
+            data = audioop.bias(data, 1, -128)
+        return audioop.lin2lin(data, sample_width, 2)
+    except audioop.error:
+        # 24-bit samples are supported since Python 3.4.
+        return None
+
+
+def _fingerprint_file_wave(path, maxlength):
+    """Fingerprint a WAV file by reading its PCM data directly, without
+    a decoder. Only the first ``maxlength`` seconds are read and the
+    duration comes from the header. Returns None if the file is not a
+    WAV file that can be read this way.
+    """
+    try:
+        audio = wave.open(path, 'rb')
+    except (wave.Error, EOFError, IOError):
+        return None
+
+    with contextlib.closing(audio):
+        samplerate = audio.getframerate()
+        channels = audio.getnchannels()
+        sample_width = audio.getsampwidth()
+        nframes = audio.getnframes()
+        if not samplerate or _to_16bit(b'', sample_width) is None:
+            return None
+
+        def blocks():
+            remaining = min(nframes, samplerate * maxlength)
+            while remaining > 0:
+                data = audio.readframes(min(remaining, WAVE_BLOCK_FRAMES))
+                if not data:
+                    break
+                remaining -= len(data) // (channels * sample_width)
+                yield _to_16bit(data, sample_width)
+
+        fp = fingerprint(samplerate, channels, blocks(), maxlength)
+
+    return nframes / samplerate, fp
+
+
 def _fingerprint_file_fpcalc(path, maxlength):
     """Fingerprint a file by calling the fpcalc application."""
     fpcalc = os.environ.get(FPCALC_ENVVAR, FPCALC_COMMAND)
@@ -314,30 +766,36 @@ def _fingerprint_file_fpcalc(path, maxlength):
 def fingerprint_file(path, maxlength=MAX_AUDIO_LENGTH):
     """Fingerprint a file either using the Chromaprint dynamic library
     or the fpcalc command-line tool, whichever is available. Returns the
-    duration and the fingerprint.
+    duration and the fingerprint. WAV files are read directly when the
+    Chromaprint library is available, without spawning a decoder.
     """
     path = os.path.abspath(os.path.expanduser(path))
-    if have_audioread and have_chromaprint:
-        return _fingerprint_file_audioread(path, maxlength)
-    else:
-        return _fingerprint_file_fpcalc(path, maxlength)
+    with Metrics.timer('fingerprint'):
+        if have_chromaprint:
+            result = _fingerprint_file_wave(path, maxlength)
+            if result is not None:
+                return result
+        if have_audioread and have_chromaprint:
+            return _fingerprint_file_audioread(path, maxlength)
+        else:
+            return _fingerprint_file_fpcalc(path, maxlength)
 
 
-def match(apikey, path, meta=DEFAULT_META, parse=True):
+def match(apikey, path, meta=DEFAULT_META, parse=True, timeout=None):
     """Look up the metadata for an audio file. If ``parse`` is true,
     then ``parse_lookup_result`` is used to return an iterator over
     small tuple of relevant information; otherwise, the full parsed JSON
-    response is returned.
+    response is returned. ``timeout`` bounds the lookup in seconds.
     """
     duration, fp = fingerprint_file(path)
-    response = lookup(apikey, fp, duration, meta)
+    response = lookup(apikey, fp, duration, meta, timeout)
     if parse:
         return parse_lookup_result(response)
     else:
         return response
 
 
-def submit(apikey, userkey, data):
+def submit(apikey, userkey, data, timeout=None):
     """Submit a fingerprint to the acoustid server. The ``apikey`` and
     ``userkey`` parameters are API keys for the application and the
     submitting user, respectively.
@@ -350,7 +808,11 @@ def submit(apikey, userkey, data):
     ``bitrate``
 
     If the required keys are not present in a dictionary, a
-    FingerprintSubmissionError is raised.
+    FingerprintSubmissionError is raised. Submissions are only retried
+    if they did not reach the service. ``timeout`` bounds the request
+    in seconds. Returns the parsed response, whose ``submissions`` have
+    the ``index`` of each accepted fingerprint. To submit many
+    fingerprints, see SubmissionQueue.
     """
     if isinstance(data, dict):
         data = [data]
@@ -366,9 +828,191 @@ def submit(apikey, userkey, data):
     for i, d in enumerate(data):
         if "duration" not in d or "fingerprint" not in d:
             raise FingerprintSubmissionError("missing required parameters")
-        for k, v in d.iteritems():
+        for k, v in d.items():
             args["%s.%s" % (k, i)] = v
 
-    response = _api_request(_get_submit_url(), args)
+    response = _api_request(_get_submit_url(), args, timeout,
+                            idempotent=False)
     if response['status'] != 'ok':
-        raise WebServiceError("status: %s" % data['status'])
+        raise WebServiceError("status: %s" % response['status'])
+    return response
+
+
+def _submission_size(data):
+    """Estimate the form data of a submission, in bytes."""
+    return sum(len(k) + len(u'{0}'.format(v)) + 4 for k, v in data.items())
+
+
+class SubmissionQueue(object):
+    """Accumulates the fingerprints of many songs and submits them in
+    batches, from a background thread. A batch is sent when it has
+    ``batch_size`` fingerprints or ``batch_bytes`` of form data, or when
+    its oldest fingerprint waited ``delay`` seconds. The fingerprints of
+    a batch that failed, or that the response does not list as
+    accepted, go back to the queue and are submitted again in a later
+    batch, up to ``max_attempts`` times. Note that a batch that failed
+    after reaching the service may have been stored, so a retried
+    fingerprint can be submitted twice.
+
+    ``callback``, if given, is called from the background thread with
+    each submitted dictionary and either the submission from the
+    response or None and the exception of the last attempt. ``close``
+    submits everything left and stops the thread.
+    """
+    def __init__(self, apikey, userkey, batch_size=None, batch_bytes=None,
+                 delay=None, max_attempts=3, callback=None, timeout=None):
+        self.apikey = apikey
+        self.userkey = userkey
+        self.batch_size = batch_size or SUBMIT_BATCH_SIZE
+        self.batch_bytes = batch_bytes or SUBMIT_BATCH_BYTES
+        self.delay = SUBMIT_BATCH_DELAY if delay is None else delay
+        self.max_attempts = max_attempts
+        self.callback = callback
+        self.timeout = timeout
+
+        # Stats.
+        self.submitted = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+
+        # Entries are [data, size, attempts, time added].
+        self._pending = []
+        self._bytes = 0
+        self._closing = False
+        self._flushing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, data):
+        """Queue a submission dictionary, with the keys described in
+        ``submit``. Raises a FingerprintSubmissionError if the required
+        keys are missing.
+        """
+        if "duration" not in data or "fingerprint" not in data:
+            raise FingerprintSubmissionError("missing required parameters")
+        with self._cond:
+            if self._closing:
+                raise AcoustidError("the submission queue is closed")
+            self._put([dict(data), _submission_size(data), 0, time.time()])
+
+    def flush(self):
+        """Submit the queued fingerprints, retries included, without
+        waiting for full batches, and wait until the queue is empty.
+        """
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._flushing and self._thread.is_alive():
+                self._cond.wait(0.1)
+
+    def close(self):
+        """Submit everything left, retries included, and stop."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _put(self, entry):
+        self._pending.append(entry)
+        self._bytes += entry[1]
+        self._cond.notify_all()
+
+    def _ready(self):
+        """Take the next batch if it should be sent now, else return
+        None.
+        """
+        if not self._pending:
+            return None
+        full = (len(self._pending) >= self.batch_size or
+                self._bytes >= self.batch_bytes)
+        old = time.time() - self._pending[0][3] >= self.delay
+        if not (full or old or self._flushing or self._closing):
+            return None
+
+        batch = []
+        size = 0
+        while self._pending and len(batch) < self.batch_size:
+            entry = self._pending[0]
+            # A batch has at least one fingerprint, even if it is large.
+            if batch and size + entry[1] > self.batch_bytes:
+                break
+            batch.append(self._pending.pop(0))
+            size += entry[1]
+        self._bytes -= size
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._ready()
+                while batch is None:
+                    if not self._pending:
+                        self._flushing = False
+                        self._cond.notify_all()
+                        if self._closing:
+                            return
+                    timeout = None
+                    if self._pending:
+                        timeout = max(self._pending[0][3] + self.delay -
+                                      time.time(), 0.01)
+                    self._cond.wait(timeout)
+                    batch = self._ready()
+
+            self._submit(batch)
+
+    def _submit(self, batch):
+        self.batches += 1
+        Metrics.count('submit_batches')
+        try:
+            response = submit(self.apikey, self.userkey,
+                              [entry[0] for entry in batch], self.timeout)
+            # The service gives the index as a string, like the
+            # suffix of the parameters.
+            accepted = dict((int(s['index']), s)
+                            for s in response.get('submissions', [])
+                            if s.get('status') != 'error')
+        except Exception as exc:
+            # Any error fails the batch, never the thread.
+            accepted, error = {}, exc
+        else:
+            error = WebServiceError('fingerprint not accepted')
+
+        retry = []
+        for i, entry in enumerate(batch):
+            submission = accepted.get(i)
+            if submission is not None:
+                self.submitted += 1
+                self._done(entry[0], submission, None)
+                continue
+
+            entry[2] += 1
+            if entry[2] < self.max_attempts:
+                retry.append(entry)
+            else:
+                self.failed += 1
+                self._done(entry[0], None, error)
+
+        if retry:
+            self.retried += len(retry)
+            Metrics.count('submit_retries', len(retry))
+            with self._cond:
+                # They wait a full delay, unless the queue is closing.
+                now = time.time()
+                for entry in retry:
+                    entry[3] = now
+                    self._put(entry)
+
+    def _done(self, data, submission, error):
+        if self.callback:
+            try:
+                self.callback(data, submission, error)
+            except Exception:
+                # The queue goes on without the caller.
+                Metrics.count('submit_callback_errors')
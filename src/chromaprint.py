@@ -116,14 +116,23 @@ class Fingerprinter(object):
 
     def feed(self, data):
         """Send raw PCM audio data to the fingerprinter. Data may be
-        either a bytestring or a buffer object.
+        either a bytestring or a buffer object. Bytestrings and
+        bytearrays are passed to the library without copying them.
         """
-        if isinstance(data, BUFFER_TYPES):
-            data = str(data)
-        elif not isinstance(data, bytes):
+        size = len(data)
+        if isinstance(data, bytes):
+            pass
+        elif isinstance(data, bytearray):
+            data = (ctypes.c_char * size).from_buffer(data)
+        elif isinstance(data, memoryview):
+            data = data.tobytes()
+            size = len(data)
+        elif isinstance(data, BUFFER_TYPES):
+            data = bytes(data)
+        else:
             raise TypeError('data must be bytes, buffer, or memoryview')
         _check(_libchromaprint.chromaprint_feed(
-            self._ctx, data, len(data) // 2
+            self._ctx, data, size // 2
         ))
 
     def finish(self):